@@ -13,6 +13,8 @@ import time
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+APPLIED_TABLE = 'raft_applied'
+
 
 def connect(db):
     """
@@ -101,26 +103,152 @@ def insert(conn, table_name, room_id, room_state='unoccupied'):
         logger.warning(e)
 
 
-def update(conn, table_name, room_id):
+def update(conn, table_name, room_id, last_applied=None):
+    """
+    :param last_applied: if given, recorded as the last applied Raft log index in the same transaction
+    """
+    try:
+        c = conn.cursor()
+        result = _book(c, table_name, room_id)
+        if last_applied is not None:
+            _set_last_applied(c, last_applied)
+        conn.commit()
+        return result
+
+    except Exception as e:
+        logger.warning("Fail to update table(%s)", table_name)
+        logger.warning(e)
+
+
+def update_many(conn, table_name, room_ids, last_applied=None):
+    """
+    Books each of room_ids in turn, in a single transaction.
+    :param last_applied: if given, recorded as the last applied Raft log index in the same transaction
+    :return: the result of each booking as for update, None for a room that could not be booked, or None if the
+        transaction failed
+    """
     try:
         c = conn.cursor()
-        c.execute('''SELECT * FROM {} WHERE RoomID={}
-                        '''.format(table_name, room_id))
-        room = c.fetchall()[0]
-        if room[2] == 'occupied':
-            logger.info("Room is booked")
-            return 0
-        else:
-            t = time.time()
-            c.execute('''UPDATE {} SET RoomState='occupied', BookTime={} WHERE RoomID={}
-                            '''.format(table_name, t, room_id))
-            conn.commit()
-            logger.info("Update RoomID(%s) to occupied", room_id)
-            return 1
+        results = []
+        for room_id in room_ids:
+            try:
+                results.append(_book(c, table_name, room_id))
+            except (IndexError, sqlite3.Error) as e:
+                logger.warning("Fail to update RoomID(%s) in table(%s)", room_id, table_name)
+                logger.warning(e)
+                results.append(None)
+        if last_applied is not None:
+            _set_last_applied(c, last_applied)
+        conn.commit()
+        logger.debug("Update %d rooms in table(%s)", len(room_ids), table_name)
+        return results
 
     except Exception as e:
+        conn.rollback()
         logger.warning("Fail to update table(%s)", table_name)
         logger.warning(e)
+        return None
+
+
+def _book(c, table_name, room_id):
+    """
+    :return: 0 if the room was already booked, 1 if it has just been booked
+    """
+    c.execute('''SELECT * FROM {} WHERE RoomID={}
+                    '''.format(table_name, room_id))
+    room = c.fetchall()[0]
+    if room[2] == 'occupied':
+        logger.info("Room is booked")
+        return 0
+    t = time.time()
+    c.execute('''UPDATE {} SET RoomState='occupied', BookTime={} WHERE RoomID={}
+                    '''.format(table_name, t, room_id))
+    logger.info("Update RoomID(%s) to occupied", room_id)
+    return 1
+
+
+def dump(conn, table_name):
+    """
+    :return: every row of the table as (RoomID, RoomState, BookTime)
+    """
+    try:
+        c = conn.cursor()
+        c.execute('''SELECT RoomID, RoomState, BookTime FROM {}
+                        '''.format(table_name))
+
+        logger.debug("Dump table(%s)", table_name)
+        return c.fetchall()
+
+    except Exception as e:
+        logger.warning("Fail to dump table(%s)", table_name)
+        logger.warning(e)
+        return None
+
+
+def restore(conn, table_name, rows, last_applied=None):
+    """
+    Replaces the contents of the table with rows, as returned by dump.
+    :param last_applied: if given, recorded as the last applied Raft log index in the same transaction
+    """
+    try:
+        c = conn.cursor()
+        c.execute('''DELETE FROM {}'''.format(table_name))
+        c.executemany('''INSERT INTO {} (RoomID, RoomState, BookTime) VALUES (?, ?, ?)
+                        '''.format(table_name), rows)
+        if last_applied is not None:
+            _set_last_applied(c, last_applied)
+        conn.commit()
+        logger.info("Restore table(%s) with %d rows", table_name, len(rows))
+        return True
+
+    except Exception as e:
+        conn.rollback()
+        logger.warning("Fail to restore table(%s)", table_name)
+        logger.warning(e)
+        return False
+
+
+def create_applied_table(conn):
+    """
+    Creates the table holding the index of the last Raft log entry applied to the database.
+    """
+    try:
+        c = conn.cursor()
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS {table_name} (
+                        ID INTEGER PRIMARY KEY CHECK (ID = 0),
+                        LastApplied INTEGER NOT NULL);
+        '''.format(table_name=APPLIED_TABLE))
+        c.execute('''INSERT OR IGNORE INTO {} (ID, LastApplied) VALUES (0, 0)
+                        '''.format(APPLIED_TABLE))
+        conn.commit()
+        logger.debug('Created table(%s) in database', APPLIED_TABLE)
+
+    except Exception as e:
+        logger.warning("Fail to create table(%s) in database", APPLIED_TABLE)
+        logger.warning(e)
+
+
+def get_last_applied(conn):
+    """
+    :return: the index of the last Raft log entry applied to the database, 0 if unknown
+    """
+    try:
+        c = conn.cursor()
+        c.execute('''SELECT LastApplied FROM {} WHERE ID=0
+                        '''.format(APPLIED_TABLE))
+        row = c.fetchone()
+        return row[0] if row else 0
+
+    except Exception as e:
+        logger.warning("Fail to read table(%s)", APPLIED_TABLE)
+        logger.warning(e)
+        return 0
+
+
+def _set_last_applied(c, last_applied):
+    c.execute('''UPDATE {} SET LastApplied=? WHERE ID=0
+                    '''.format(APPLIED_TABLE), (last_applied,))
 
 
 if __name__ == '__main__':
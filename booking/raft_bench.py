@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the persistent state of a Raft node (NodePersistentState) through scripted workloads and prints the results
+as JSON, one object per workload, so that runs can be compared to spot regressions.
+
+Workloads:
+    append      append_log() of single entries, each waiting until it is on disk
+    append_async  append_log(sync=False) of single entries, waiting for all of them at the end (group commit)
+    truncate    conflict truncations: delete the last --truncate_depth entries and append replacements in a new term
+    term        set_term() with a vote, as done when granting a vote or starting an election
+    load        cold NodePersistentState.load() of logs with --sizes entries, followed by reading the last entry
+
+Example:
+    $ python3 booking/raft_bench.py --workloads append load --sizes 10000 100000 1000000
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional
+
+from raft_cluster import percentile
+from raft_log import SegmentedLog, log_dirpath
+from raft_messages import DbEntriesMessage
+from raft_states import NodePersistentState, Entry
+
+# log backends to benchmark, by name: each opens the persistent state stored at a path
+BACKENDS: Dict[str, Callable[..., NodePersistentState]] = {
+    'segmented': NodePersistentState.load,
+}
+
+
+class IoCounter(object):
+    """
+    IoCounter counts the fsync calls made, and the bytes written by the process (from /proc/self/io, where
+    available), while it is active.
+    """
+
+    def __init__(self):
+        self.fsyncs: int = 0
+        self.bytes_written: Optional[int] = None
+        self._wchar: Optional[int] = None
+        self._os_fsync = os.fsync
+
+    def __enter__(self) -> 'IoCounter':
+        def counting_fsync(fd):
+            self.fsyncs += 1
+            self._os_fsync(fd)
+
+        os.fsync = counting_fsync
+        self._wchar = IoCounter.read_wchar()
+        return self
+
+    def __exit__(self, *exc_info):
+        os.fsync = self._os_fsync
+        wchar = IoCounter.read_wchar()
+        self.bytes_written = None if wchar is None or self._wchar is None else wchar - self._wchar
+
+    @staticmethod
+    def read_wchar() -> Optional[int]:
+        try:
+            with open('/proc/self/io', 'r') as f:
+                for line in f:
+                    if line.startswith('wchar:'):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+        return None
+
+
+def result(workload: str, ops: int, elapsed: float, latencies: List[float], io: IoCounter, **extra) -> Dict:
+    obj = {
+        'workload': workload,
+        'ops': ops,
+        'seconds': round(elapsed, 6),
+        'ops_per_sec': round(ops / elapsed, 1) if elapsed > 0 else None,
+        'bytes_written': io.bytes_written,
+        'fsyncs': io.fsyncs,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 4),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 4),
+    }
+    obj.update(extra)
+    return obj
+
+
+def payload(i: int) -> bytes:
+    return bytes(DbEntriesMessage(100 + i % 900))
+
+
+def new_entry(term: int, i: int) -> Entry:
+    return Entry(term, payload(i))
+
+
+def build_log(fpath: str, entries: int, batch_size: int = 1000):
+    """
+    Writes a log of entries entries for fpath directly, without fsyncing, to set up the load workload quickly.
+    """
+    log = SegmentedLog(log_dirpath(fpath), fsync=False)
+    for start in range(0, entries, batch_size):
+        log.append([(1, payload(i)) for i in range(start, min(entries, start + batch_size))])
+    log.close()
+
+
+def bench_append(open_state: Callable, fpath: str, args) -> Dict:
+    state = open_state(fpath)
+    latencies = []
+    with IoCounter() as io:
+        start = time.perf_counter()
+        for i in range(args.ops):
+            t = time.perf_counter()
+            state.append_log(new_entry(1, i))
+            latencies.append(time.perf_counter() - t)
+        elapsed = time.perf_counter() - start
+    state.close()
+    return result('append', args.ops, elapsed, latencies, io)
+
+
+def bench_append_async(open_state: Callable, fpath: str, args) -> Dict:
+    state = open_state(fpath)
+    latencies = []
+    with IoCounter() as io:
+        start = time.perf_counter()
+        idx = 0
+        for i in range(args.ops):
+            t = time.perf_counter()
+            idx = state.append_log(new_entry(1, i), sync=False)
+            latencies.append(time.perf_counter() - t)
+        state.wait_durable(idx)
+        elapsed = time.perf_counter() - start
+    stats = state.get_log_stats()
+    state.close()
+    return result('append_async', args.ops, elapsed, latencies, io, batches=stats.get('batches'))
+
+
+def bench_truncate(open_state: Callable, fpath: str, args) -> Dict:
+    state = open_state(fpath)
+    depth = args.truncate_depth
+    for i in range(depth):
+        state.append_log(new_entry(1, i), sync=False)
+    state.wait_durable(depth)
+    latencies = []
+    with IoCounter() as io:
+        start = time.perf_counter()
+        for term in range(2, args.ops + 2):
+            t = time.perf_counter()
+            last_idx, _ = state.get_last_log()
+            state.set_logs(state.get_logs()[:last_idx - depth])
+            for i in range(depth):
+                state.append_log(new_entry(term, i), sync=False)
+            state.wait_durable(last_idx)
+            latencies.append(time.perf_counter() - t)
+        elapsed = time.perf_counter() - start
+    state.close()
+    return result('truncate', args.ops, elapsed, latencies, io, depth=depth)
+
+
+def bench_term(open_state: Callable, fpath: str, args) -> Dict:
+    state = open_state(fpath)
+    latencies = []
+    with IoCounter() as io:
+        start = time.perf_counter()
+        for i in range(args.ops):
+            t = time.perf_counter()
+            state.set_term(state.get_term() + 1, i % 3)
+            latencies.append(time.perf_counter() - t)
+        elapsed = time.perf_counter() - start
+    state.close()
+    return result('term', args.ops, elapsed, latencies, io)
+
+
+def bench_load(open_state: Callable, fpath: str, args) -> List[Dict]:
+    results = []
+    for size in args.sizes:
+        size_fpath = '%s.%d.json' % (os.path.splitext(fpath)[0], size)
+        build_log(size_fpath, size)
+        latencies = []
+        with IoCounter() as io:
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                t = time.perf_counter()
+                state = open_state(size_fpath)
+                last_idx, _ = state.get_last_log()
+                latencies.append(time.perf_counter() - t)
+                state.close()
+                assert last_idx == size, 'loaded %d entries, expected %d' % (last_idx, size)
+            elapsed = time.perf_counter() - start
+        results.append(result('load', args.repeat, elapsed, latencies, io, entries=size))
+    return results
+
+
+WORKLOADS: Dict[str, Callable] = {
+    'append': bench_append,
+    'append_async': bench_append_async,
+    'truncate': bench_truncate,
+    'term': bench_term,
+    'load': bench_load,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the persistent state of a Raft node")
+    parser.add_argument("--backend", type=str, choices=sorted(BACKENDS), default='segmented')
+    parser.add_argument("--workloads", type=str, nargs="+", choices=list(WORKLOADS), default=list(WORKLOADS))
+    parser.add_argument("--ops", type=int, default=1000, help="operations per workload")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000],
+                        help="log sizes, in entries, for the load workload")
+    parser.add_argument("--repeat", type=int, default=5, help="loads per log size")
+    parser.add_argument("--truncate_depth", type=int, default=5)
+    parser.add_argument("--no_fsync", action="store_true", help="do not fsync, to measure everything else")
+    parser.add_argument("--dir", type=str, default=None, help="directory to work in (default: a temporary one)")
+    parser.add_argument("--output", type=str, default=None, help="write the results here instead of stdout")
+    args = parser.parse_args()
+
+    backend = BACKENDS[args.backend]
+
+    def open_state(fpath):
+        return backend(fpath, fsync=not args.no_fsync)
+
+    dirpath = tempfile.mkdtemp(prefix='raft_bench.', dir=args.dir)
+    results = []
+    try:
+        for name in args.workloads:
+            workload_dir = os.path.join(dirpath, name)
+            os.makedirs(workload_dir)
+            out = WORKLOADS[name](open_state, os.path.join(workload_dir, 'state.json'), args)
+            results.extend(out if isinstance(out, list) else [out])
+    finally:
+        shutil.rmtree(dirpath, ignore_errors=True)
+
+    report = {
+        'backend': args.backend,
+        'fsync': not args.no_fsync,
+        'results': results,
+    }
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        json.dump(report, out, indent=2)
+        out.write('\n')
+    finally:
+        if args.output:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
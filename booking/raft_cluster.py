@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Helpers for the scripts that run a Raft cluster in a single process (raft_stress.py, raft_failover.py) and report
+latencies (those and raft_bench.py).
+"""
+import os
+import socketserver
+import threading
+import time
+from typing import List, Optional
+
+import operation
+from raft_node import Node
+from raft_peer import Peer
+from raft_states import NodePersistentState
+
+
+def percentile(latencies: List[float], p: float) -> float:
+    if not latencies:
+        return 0.0
+    ordered = sorted(latencies)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+def start_cluster(dirpath: str, host: str, port: int, node_ids: List[int], peer_ids: Optional[List[int]] = None,
+                  **node_kwargs) -> List[Node]:
+    """
+    Starts a node for each of node_ids, each on a thread of its own, listening on port + its id, and keeping its
+    database and persistent state in dirpath.
+    :param peer_ids: the ids of the whole cluster, if it has members besides node_ids, e.g. ones started otherwise
+    :param node_kwargs: passed on to each Node
+    """
+    # restarting on the ports of a cluster just stopped must not wait for their connections to time out
+    socketserver.TCPServer.allow_reuse_address = True
+    peer_ids = node_ids if peer_ids is None else peer_ids
+    nodes = []
+    for node_id in node_ids:
+        peers = [Peer(i, host, port + i) for i in peer_ids if i != node_id]
+        conn = operation.connect(os.path.join(dirpath, '%d.db' % node_id))
+        operation.create_table(conn, 'room')
+        state = NodePersistentState.load(os.path.join(dirpath, '%d.json' % node_id))
+        node = Node(node_id, state, peers, conn, **node_kwargs)
+        thread = threading.Thread(target=node.start, args=[host, port + node_id])
+        thread.daemon = True
+        thread.start()
+        nodes.append(node)
+    return nodes
+
+
+def find_leader(nodes: List[Node]) -> Optional[Node]:
+    """
+    :return: the one node of nodes that leads, or None if none or several think they do
+    """
+    leaders = [node for node in nodes if node.is_leader()]
+    if len(leaders) != 1:
+        return None
+    return leaders[0]
+
+
+def wait_for_leader(nodes: List[Node], timeout: float) -> Node:
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        leader = find_leader(nodes)
+        if leader is not None:
+            return leader
+        time.sleep(0.005)
+    raise RuntimeError('no leader elected within %.1fs' % timeout)
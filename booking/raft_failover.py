@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Failover benchmark for a Raft cluster: starts a cluster of real nodes in this process, stops its leader, and measures
+how long the remaining nodes take to elect a new leader, and for that leader to commit a booking. Repeats this with a
+new cluster for each trial, and prints the timings as JSON.
+
+A new leader is elected within an election timeout or so of the last heartbeat from the old one, plus a round of
+RequestVote, so failover takes about election_timeout_ms_max at worst, unless votes are split.
+
+Example:
+    $ python3 booking/raft_failover.py --nodes 3 --trials 10 --election-timeout-ms 150 300 --heartbeat-ms 30
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+from raft_cluster import find_leader, percentile, start_cluster
+from raft_messages import DbEntriesMessage
+from raft_node import Node
+from raft_peer import Peer
+from raft_rpc_client import RpcClient
+
+
+def book(client: RpcClient, host: str, port: int, nodes: List[Node], timeout: float) -> Optional[float]:
+    """
+    Books a room through whichever node leads, until one commits it.
+    :return: when it was committed, on the monotonic clock, or None if none did within timeout
+    """
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        leader = find_leader(nodes)
+        if leader is not None:
+            try:
+                _, ok, _ = client.send_booking(Peer(leader._node_id, host, port + leader._node_id),
+                                               DbEntriesMessage(101))
+            except Exception:
+                ok = False
+            if ok:
+                return time.monotonic()
+        time.sleep(0.001)
+    return None
+
+
+def trial(dirpath: str, host: str, port: int, args) -> Dict[str, Optional[float]]:
+    nodes = start_cluster(dirpath, host, port, list(range(args.nodes)),
+                          election_timeout_ms_min=args.election_timeout_ms[0],
+                          election_timeout_ms_max=args.election_timeout_ms[1], loop_interval_ms=args.heartbeat_ms,
+                          snapshot_threshold=0, pre_vote=not args.no_pre_vote)
+    client = RpcClient(timeout=args.timeout)
+    if book(client, host, port, nodes, args.timeout) is None:
+        raise RuntimeError('the cluster did not commit a booking within %.1fs' % args.timeout)
+    leader = find_leader(nodes)
+    # let a heartbeat go out after the booking, so that every follower's election timeout starts over
+    time.sleep(args.heartbeat_ms / 1000)
+
+    stopped_at = time.monotonic()
+    leader.stop()
+    survivors = [node for node in nodes if node is not leader]
+    elected_at = None
+    end = stopped_at + args.timeout
+    while elected_at is None and time.monotonic() < end:
+        if find_leader(survivors) is not None:
+            elected_at = time.monotonic()
+        else:
+            time.sleep(0.001)
+    committed_at = book(client, host, port, survivors, max(0.0, end - time.monotonic()))
+    for node in survivors:
+        node.stop()
+    return {
+        'elected_ms': None if elected_at is None else (elected_at - stopped_at) * 1000,
+        'committed_ms': None if committed_at is None else (committed_at - stopped_at) * 1000,
+    }
+
+
+def summary(timings: List[Optional[float]]) -> Dict[str, object]:
+    done = [t for t in timings if t is not None]
+    return {
+        'failed': len(timings) - len(done),
+        'p50_ms': round(percentile(done, 50), 3),
+        'p99_ms': round(percentile(done, 99), 3),
+        'max_ms': round(max(done, default=0), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure how long a Raft cluster takes to recover from losing its "
+                                                 "leader")
+    parser.add_argument("--nodes", type=int, default=3, help="nodes in the cluster")
+    parser.add_argument("--trials", type=int, default=10, help="clusters to start, and leaders to stop")
+    parser.add_argument("--port", type=int, default=9400, help="first port; each trial uses the next --nodes ports")
+    parser.add_argument("--election-timeout-ms", type=int, nargs=2, default=[150, 300], metavar=('MIN', 'MAX'),
+                        help="election timeout range, in milliseconds")
+    parser.add_argument("--heartbeat-ms", type=int, default=30, help="heartbeat interval, in milliseconds")
+    parser.add_argument("--no-pre-vote", action="store_true", help="start elections without asking for pre-votes")
+    parser.add_argument("--timeout", type=float, default=10.0, help="give up on a trial after this many seconds")
+    parser.add_argument("--dir", type=str, default=None, help="where to keep the nodes' data (default: a temporary "
+                                                              "directory, which is not removed)")
+    parser.add_argument("--verbose", action="store_true", help="log what the nodes are doing")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.disable(logging.CRITICAL)
+
+    host = '127.0.0.1'
+    dirpath = tempfile.mkdtemp(prefix='raft_failover.', dir=args.dir)
+    results = []
+    for i in range(args.trials):
+        trial_dirpath = os.path.join(dirpath, str(i))
+        os.mkdir(trial_dirpath)
+        results.append(trial(trial_dirpath, host, args.port + i * args.nodes, args))
+
+    report = {
+        'nodes': args.nodes,
+        'trials': args.trials,
+        'election_timeout_ms': args.election_timeout_ms,
+        'heartbeat_ms': args.heartbeat_ms,
+        'pre_vote': not args.no_pre_vote,
+        'dir': dirpath,
+        'elected': summary([r['elected_ms'] for r in results]),
+        'committed': summary([r['committed_ms'] for r in results]),
+    }
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,849 @@
+#!/usr/bin/env python
+import array
+import bisect
+import collections
+import logging
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from typing import List, Optional, Tuple, Iterator, Dict, Callable
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+
+DEFAULT_SEGMENT_SIZE = 4 * 1024 * 1024
+
+
+class _Segment(object):
+    """
+    _Segment is a single segment file of a SegmentedLog.
+    It holds entries first_idx..first_idx+len(offsets)-1 and knows the byte offset and term of each of them.
+    """
+
+    def __init__(self, path: str, first_idx: int):
+        self.path: str = path
+        self.first_idx: int = first_idx
+        self.offsets: array.array = array.array('Q')
+        self.terms: array.array = array.array('Q')
+        self.size: int = 0
+
+    def last_idx(self) -> int:
+        return self.first_idx + len(self.offsets) - 1
+
+    def index_path(self) -> str:
+        return os.path.splitext(self.path)[0] + SegmentedLog.INDEX_SUFFIX
+
+    def __repr__(self):
+        return "_Segment(%s first_idx:%d entries:%d size:%d)" % (self.path, self.first_idx, len(self.offsets),
+                                                                self.size)
+
+
+class LogSlice(object):
+    """
+    LogSlice holds a run of consecutive log records first_idx..last_idx() without an object per record: their terms
+    are kept in an array and their payloads back to back in a single buffer, with offsets[i]:offsets[i+1] delimiting
+    the payload of the i-th record.
+    """
+
+    __slots__ = ('first_idx', 'terms', 'offsets', 'buf')
+
+    def __init__(self, first_idx: int):
+        self.first_idx: int = first_idx
+        self.terms: array.array = array.array('Q')
+        self.offsets: array.array = array.array('Q', [0])
+        self.buf: bytearray = bytearray()
+
+    def append(self, term: int, payload: bytes):
+        self.terms.append(term)
+        self.buf += payload
+        self.offsets.append(len(self.buf))
+
+    def extend(self, records: List[Tuple[int, bytes]]):
+        for term, payload in records:
+            self.append(term, payload)
+
+    def last_idx(self) -> int:
+        return self.first_idx + len(self.terms) - 1
+
+    def term_at(self, idx: int) -> int:
+        return self.terms[self._pos(idx)]
+
+    def payload_at(self, idx: int) -> bytes:
+        pos = self._pos(idx)
+        return bytes(self.buf[self.offsets[pos]:self.offsets[pos + 1]])
+
+    def _pos(self, idx: int) -> int:
+        pos = idx - self.first_idx
+        if not 0 <= pos < len(self.terms):
+            raise IndexError('LogSlice: index %d out of range' % idx)
+        return pos
+
+    def __len__(self) -> int:
+        return len(self.terms)
+
+    def __iter__(self) -> Iterator[Tuple[int, bytes]]:
+        for pos in range(len(self.terms)):
+            yield self.terms[pos], bytes(self.buf[self.offsets[pos]:self.offsets[pos + 1]])
+
+    def __repr__(self):
+        return 'LogSlice(%d..%d bytes:%d)' % (self.first_idx, self.last_idx(), len(self.buf))
+
+
+class SegmentedLog(object):
+    """
+    SegmentedLog is an append-only on-disk log split across segment files of (roughly) fixed size.
+    Each segment file is named after the index of its first entry, and each record is framed as:
+        <u32 payload length><u64 term><u32 CRC32 of length, term and payload><payload>
+    so a record torn by a crash in the middle of a write, or damaged since, is detected instead of being read back.
+    An in-memory index maps every log index to its segment, byte offset and term (kept in compact arrays, the
+    payloads themselves are only read when asked for), so appending only ever writes
+    the new records and deleting a suffix of the log is a tail truncate of one segment (plus unlinking any later ones).
+    Log indexes start at 1, as in the Raft paper. Once a prefix of the log is covered by a snapshot, the segments
+    holding it are unlinked by compact(), so the first index of the log may be greater than 1.
+    When a segment is full, its index is checkpointed to a .idx file next to it:
+        <u64 segment size><u64 number of records><offsets><terms>
+    with the two arrays in native byte order. On open, full segments load their index from that file and only the
+    last segment is scanned record by record, so opening a long log does not read it all. The scan stops at the first
+    record that is incomplete or fails its checksum, and the segment is truncated there: that is the tail of the write
+    in progress when we crashed, which was never acknowledged as durable.
+    """
+
+    HEADER = struct.Struct('>IQI')
+    CHECKSUMMED = struct.Struct('>IQ')  # the part of the header covered by the checksum
+    INDEX_HEADER = struct.Struct('>QQ')
+    SEGMENT_SUFFIX = '.seg'
+    INDEX_SUFFIX = '.idx'
+
+    def __init__(self, dirpath: str, segment_size: int = DEFAULT_SEGMENT_SIZE, fsync: bool = True):
+        self._dirpath: str = dirpath
+        self._segment_size: int = segment_size
+        self._fsync: bool = fsync
+        self._segments: List[_Segment] = []
+        self._first_idxs: List[int] = []  # kept in step with _segments for bisecting
+        self._base_idx: int = 0  # index preceding the first record when there are no segments
+        self._active = None  # file object of the last segment, opened for appending
+        self._bytes_written: int = 0
+        self._fsyncs: int = 0
+        if not os.path.isdir(dirpath):
+            os.makedirs(dirpath)
+        self._open()
+
+    def _open(self):
+        names = sorted(n for n in os.listdir(self._dirpath) if n.endswith(SegmentedLog.SEGMENT_SUFFIX))
+        for name in names:
+            first_idx = int(name[:-len(SegmentedLog.SEGMENT_SUFFIX)])
+            segment = _Segment(os.path.join(self._dirpath, name), first_idx)
+            if self._segments:
+                # the previous segment is full
+                previous = self._segments[-1]
+                if not self._load_index(previous):
+                    self._scan(previous, repair=False)
+                    self._save_index(previous)
+                if previous.last_idx() + 1 != first_idx:
+                    raise RuntimeError('SegmentedLog: segment %s does not follow %s' % (segment, previous))
+            self._segments.append(segment)
+            self._first_idxs.append(first_idx)
+        if self._segments:
+            last = self._segments[-1]
+            if os.path.exists(last.index_path()):
+                os.unlink(last.index_path())
+            self._scan(last, repair=True)
+        LOG.debug("SegmentedLog open dirpath:%s segments:%s", self._dirpath, self._segments)
+
+    def _scan(self, segment: _Segment, repair: bool):
+        """
+        _scan rebuilds the index of a segment in a single pass over it, verifying each record.
+        :param repair: truncate the segment at the first bad record. Only the last segment may end with one: anywhere
+                       else it means records the log holds after it are damaged, and an IOError is raised instead.
+        """
+        del segment.offsets[:]
+        del segment.terms[:]
+        with open(segment.path, 'rb') as f:
+            data = f.read()
+        offset = 0
+        while offset < len(data):
+            record = SegmentedLog._decode(data, offset)
+            if record is None:
+                break
+            term, _, end = record
+            segment.offsets.append(offset)
+            segment.terms.append(term)
+            offset = end
+        segment.size = offset
+        if segment.size < len(data):
+            if not repair:
+                raise IOError('SegmentedLog: bad record at offset %d of %s' % (segment.size, segment.path))
+            LOG.warning("SegmentedLog: dropping %d trailing bytes of torn or corrupt record in %s",
+                        len(data) - segment.size, segment.path)
+            os.truncate(segment.path, segment.size)
+
+    @staticmethod
+    def _encode(term: int, payload: bytes) -> bytes:
+        checksum = zlib.crc32(payload, zlib.crc32(SegmentedLog.CHECKSUMMED.pack(len(payload), term)))
+        return SegmentedLog.HEADER.pack(len(payload), term, checksum) + payload
+
+    @staticmethod
+    def _decode(data: bytes, offset: int) -> Optional[Tuple[int, bytes, int]]:
+        """
+        _decode reads the record starting at offset in data.
+        :return: (term, payload, offset just past the record), or None if the record is incomplete or corrupt
+        """
+        if offset + SegmentedLog.HEADER.size > len(data):
+            return None
+        length, term, checksum = SegmentedLog.HEADER.unpack_from(data, offset)
+        start = offset + SegmentedLog.HEADER.size
+        end = start + length
+        if end > len(data):
+            return None
+        payload = data[start:end]
+        if zlib.crc32(payload, zlib.crc32(SegmentedLog.CHECKSUMMED.pack(length, term))) != checksum:
+            return None
+        return term, payload, end
+
+    def _decode_at(self, segment: _Segment, data: bytes, offset: int) -> Tuple[int, bytes, int]:
+        record = SegmentedLog._decode(data, offset)
+        if record is None:
+            raise IOError('SegmentedLog: bad record in %s' % segment.path)
+        return record
+
+    def _load_index(self, segment: _Segment) -> bool:
+        """
+        _load_index loads the checkpointed index of a full segment.
+        :return: False if there is no usable checkpoint, and the segment has to be scanned instead
+        """
+        try:
+            with open(segment.index_path(), 'rb') as f:
+                size, count = SegmentedLog.INDEX_HEADER.unpack(f.read(SegmentedLog.INDEX_HEADER.size))
+                if size != os.path.getsize(segment.path):
+                    return False
+                segment.offsets.fromfile(f, count)
+                segment.terms.fromfile(f, count)
+        except (OSError, EOFError, struct.error) as e:
+            LOG.warning("SegmentedLog: unable to load index of %s: %s", segment.path, e)
+            del segment.offsets[:]
+            del segment.terms[:]
+            return False
+        segment.size = size
+        return True
+
+    def _save_index(self, segment: _Segment):
+        data = SegmentedLog.INDEX_HEADER.pack(segment.size, len(segment.offsets)) + \
+               segment.offsets.tobytes() + segment.terms.tobytes()
+        write_atomic(segment.index_path(), data, self._fsync)
+
+    def _remove(self, segment: _Segment):
+        if os.path.exists(segment.index_path()):
+            os.unlink(segment.index_path())
+        os.unlink(segment.path)
+
+    def __len__(self) -> int:
+        return self.last_idx()
+
+    def first_idx(self) -> int:
+        if not self._segments:
+            return self._base_idx + 1
+        return self._segments[0].first_idx
+
+    def last_idx(self) -> int:
+        if not self._segments:
+            return self._base_idx
+        return self._segments[-1].last_idx()
+
+    def _segment_for(self, idx: int) -> _Segment:
+        if idx < self.first_idx() or idx > self.last_idx():
+            raise IndexError('SegmentedLog: index %d out of range' % idx)
+        pos = bisect.bisect_right(self._first_idxs, idx) - 1
+        return self._segments[pos]
+
+    def append(self, records: List[Tuple[int, bytes]]) -> int:
+        """
+        append writes records to the end of the log.
+        :param records: list of (term, payload)
+        :return: the index of the last record written
+        """
+        for term, payload in records:
+            record = SegmentedLog._encode(term, payload)
+            segment = self._active_segment(len(record))
+            self._active.write(record)
+            self._bytes_written += len(record)
+            segment.terms.append(term)
+            segment.offsets.append(segment.size)
+            segment.size += len(record)
+        if records:
+            self._sync()
+        return self.last_idx()
+
+    def _active_segment(self, record_size: int) -> _Segment:
+        if self._segments:
+            segment = self._segments[-1]
+            if segment.offsets and segment.size + record_size > self._segment_size:
+                self._sync()
+                self._save_index(segment)
+                self._new_segment(segment.last_idx() + 1)
+        else:
+            self._new_segment(self._base_idx + 1)
+        if self._active is None:
+            self._active = open(self._segments[-1].path, 'ab')
+        return self._segments[-1]
+
+    def _new_segment(self, first_idx: int):
+        self._close_active()
+        path = os.path.join(self._dirpath, '%020d%s' % (first_idx, SegmentedLog.SEGMENT_SUFFIX))
+        open(path, 'wb').close()
+        self._segments.append(_Segment(path, first_idx))
+        self._first_idxs.append(first_idx)
+        self._sync_dir()
+        LOG.debug("SegmentedLog new segment:%s", path)
+
+    def truncate(self, idx: int):
+        """
+        truncate deletes the record at idx and all that follow it.
+        """
+        if idx > self.last_idx():
+            return
+        self._close_active()
+        while self._segments and self._segments[-1].first_idx >= max(idx, 1):
+            segment = self._segments.pop()
+            self._first_idxs.pop()
+            self._remove(segment)
+            self._base_idx = segment.first_idx - 1
+        if self._segments:
+            segment = self._segments[-1]
+            if os.path.exists(segment.index_path()):
+                os.unlink(segment.index_path())  # it is the last segment again
+            keep = idx - segment.first_idx
+            if keep < len(segment.offsets):
+                segment.size = segment.offsets[keep]
+                del segment.offsets[keep:]
+                del segment.terms[keep:]
+                os.truncate(segment.path, segment.size)
+        self._sync_dir()
+        LOG.debug("SegmentedLog truncate idx:%d last_idx:%d", idx, self.last_idx())
+
+    def compact(self, idx: int):
+        """
+        compact unlinks the segments that only hold records up to and including idx.
+        Records up to idx that share a segment with later ones are kept on disk until that segment goes too.
+        If idx is at or beyond the end of the log, the log is left empty and continues at idx + 1.
+        """
+        while self._segments and self._segments[0].last_idx() <= idx:
+            if len(self._segments) == 1:
+                self._close_active()
+            segment = self._segments.pop(0)
+            self._first_idxs.pop(0)
+            self._remove(segment)
+        if not self._segments:
+            self._base_idx = max(self._base_idx, idx)
+        self._sync_dir()
+        LOG.debug("SegmentedLog compact idx:%d first_idx:%d last_idx:%d", idx, self.first_idx(), self.last_idx())
+
+    def reset(self, idx: int):
+        """
+        reset deletes every record, so that the next record appended gets index idx + 1.
+        """
+        self._close_active()
+        for segment in self._segments:
+            self._remove(segment)
+        self._segments = []
+        self._first_idxs = []
+        self._base_idx = idx
+        self._sync_dir()
+        LOG.debug("SegmentedLog reset idx:%d", idx)
+
+    def read(self, idx: int) -> Tuple[int, bytes]:
+        """
+        read returns the (term, payload) of the record at idx.
+        """
+        segment = self._segment_for(idx)
+        with open(segment.path, 'rb') as f:
+            f.seek(segment.offsets[idx - segment.first_idx])
+            header = f.read(SegmentedLog.HEADER.size)
+            length, _, _ = SegmentedLog.HEADER.unpack(header)
+            term, payload, _ = self._decode_at(segment, header + f.read(length), 0)
+            return term, payload
+
+    def term(self, idx: int) -> int:
+        """
+        term returns the term of the record at idx, without reading it from disk.
+        """
+        segment = self._segment_for(idx)
+        return segment.terms[idx - segment.first_idx]
+
+    def slice(self, lo: int, hi: int) -> LogSlice:
+        """
+        slice returns the records lo..hi-1, or as many of them as the log holds, reading each segment involved with a
+        single read.
+        :raises IndexError: if lo is before the first record of the log
+        """
+        if lo < self.first_idx():
+            raise IndexError('SegmentedLog: index %d out of range' % lo)
+        result = LogSlice(lo)
+        hi = min(hi, self.last_idx() + 1)
+        idx = lo
+        while idx < hi:
+            segment = self._segment_for(idx)
+            start, stop = idx - segment.first_idx, min(hi, segment.last_idx() + 1) - segment.first_idx
+            begin = segment.offsets[start]
+            end = segment.offsets[stop] if stop < len(segment.offsets) else segment.size
+            with open(segment.path, 'rb') as f:
+                f.seek(begin)
+                data = f.read(end - begin)
+            for offset in segment.offsets[start:stop]:
+                _, payload, _ = self._decode_at(segment, data, offset - begin)
+                result.buf += payload
+                result.offsets.append(len(result.buf))
+            result.terms.extend(segment.terms[start:stop])
+            idx = segment.first_idx + stop
+        return result
+
+    def __iter__(self) -> Iterator[Tuple[int, bytes]]:
+        return self.iterate(self.first_idx())
+
+    def iterate(self, start_idx: int) -> Iterator[Tuple[int, bytes]]:
+        """
+        iterate yields the (term, payload) of every record from start_idx onwards.
+        """
+        for segment in list(self._segments):
+            if segment.last_idx() < start_idx:
+                continue
+            with open(segment.path, 'rb') as f:
+                data = f.read(segment.size)
+            for offset in segment.offsets[max(0, start_idx - segment.first_idx):]:
+                term, payload, _ = self._decode_at(segment, data, offset)
+                yield term, payload
+
+    def close(self):
+        self._close_active()
+
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            'bytes_written': self._bytes_written,
+            'fsyncs': self._fsyncs,
+        }
+
+    def _flush(self):
+        if self._active is not None:
+            self._active.flush()
+
+    def _sync(self):
+        self._flush()
+        if self._active is not None and self._fsync:
+            os.fsync(self._active.fileno())
+            self._fsyncs += 1
+
+    def _sync_dir(self):
+        if not self._fsync:
+            return
+        fd = os.open(self._dirpath, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            self._fsyncs += 1
+        finally:
+            os.close(fd)
+
+    def _close_active(self):
+        if self._active is not None:
+            self._sync()
+            self._active.close()
+            self._active = None
+
+
+class GroupCommitLog(object):
+    """
+    GroupCommitLog wraps a SegmentedLog so that appends arriving close together are written with one write and one
+    fsync. append_async() hands records to a background flusher and returns the index they will have straight away;
+    wait_durable() blocks until they are on disk. The flusher takes everything that arrived while the previous batch
+    was being written, up to max_batch_size records, waiting at most max_delay_ms after the first of them for more to
+    arrive (0 means do not wait at all).
+    Records that are queued or being written can already be read back.
+    Truncation, compaction and reset wait for pending appends to be flushed first.
+    """
+
+    def __init__(self, log: SegmentedLog, max_batch_size: int = 256, max_delay_ms: float = 0):
+        self._log: SegmentedLog = log
+        self._max_batch_size: int = max_batch_size
+        self._max_delay_ms: float = max_delay_ms
+        self._cond: threading.Condition = threading.Condition()
+        self._pending: List[Tuple[int, bytes]] = []
+        self._pending_since: float = 0
+        self._flushing: List[Tuple[int, bytes]] = []  # the batch being written
+        self._error: Optional[Exception] = None
+        self._closed: bool = False
+        self._last_idx: int = log.last_idx()
+        self._durable_idx: int = log.last_idx()
+        self._batch_sizes: Dict[int, int] = {}  # batch size -> number of batches of that size
+        thread = threading.Thread(target=self._flush_forever)
+        thread.daemon = True
+        thread.start()
+
+    def __len__(self) -> int:
+        return self.last_idx()
+
+    def first_idx(self) -> int:
+        with self._cond:
+            return self._log.first_idx()
+
+    def last_idx(self) -> int:
+        with self._cond:
+            return self._last_idx
+
+    def durable_idx(self) -> int:
+        """
+        durable_idx returns the index of the last record on disk.
+        """
+        with self._cond:
+            return self._durable_idx
+
+    def append(self, records: List[Tuple[int, bytes]]) -> int:
+        """
+        append writes records to the end of the log and waits until they are on disk.
+        :return: the index of the last record written
+        """
+        idx = self.append_async(records)
+        self.wait_durable(idx)
+        return idx
+
+    def append_async(self, records: List[Tuple[int, bytes]]) -> int:
+        """
+        append_async queues records to be written to the end of the log.
+        :return: the index the last record will have; pass it to wait_durable
+        """
+        with self._cond:
+            if not records:
+                return self._last_idx
+            if not self._pending:
+                self._pending_since = time.monotonic()
+            self._pending.extend(records)
+            self._last_idx += len(records)
+            self._cond.notify_all()
+            return self._last_idx
+
+    def wait_durable(self, idx: int):
+        """
+        wait_durable blocks until every record up to idx is on disk.
+        """
+        with self._cond:
+            while self._durable_idx < idx and self._error is None:
+                self._cond.wait()
+            if self._error is not None:
+                raise self._error
+
+    def _flush_forever(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                deadline = self._pending_since + self._max_delay_ms / 1000
+                while len(self._pending) < self._max_batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._pending[:self._max_batch_size]
+                del self._pending[:self._max_batch_size]
+                self._pending_since = time.monotonic()
+                self._flushing = batch
+            # appends arriving while we write this batch make up the next one
+            try:
+                durable_idx = self._log.append(batch)
+            except Exception as e:
+                LOG.error("GroupCommitLog: failed to write %d records: %s", len(batch), e)
+                with self._cond:
+                    self._error = e
+                    self._flushing = []
+                    self._cond.notify_all()
+                return
+            with self._cond:
+                self._flushing = []
+                self._durable_idx = durable_idx
+                self._batch_sizes[len(batch)] = self._batch_sizes.get(len(batch), 0) + 1
+                self._cond.notify_all()
+
+    def _quiesce(self):
+        # must be called with self._cond held
+        while (self._pending or self._flushing) and self._error is None:
+            self._cond.wait()
+        if self._error is not None:
+            raise self._error
+
+    def truncate(self, idx: int):
+        with self._cond:
+            self._quiesce()
+            self._log.truncate(idx)
+            self._last_idx = self._durable_idx = self._log.last_idx()
+
+    def compact(self, idx: int):
+        with self._cond:
+            self._quiesce()
+            self._log.compact(idx)
+            self._last_idx = self._durable_idx = self._log.last_idx()
+
+    def reset(self, idx: int):
+        with self._cond:
+            self._quiesce()
+            self._log.reset(idx)
+            self._last_idx = self._durable_idx = self._log.last_idx()
+
+    def read(self, idx: int) -> Tuple[int, bytes]:
+        with self._cond:
+            if idx > self._durable_idx:
+                return self._unflushed(idx)
+        return self._log.read(idx)
+
+    def term(self, idx: int) -> int:
+        with self._cond:
+            if idx > self._durable_idx:
+                term, _ = self._unflushed(idx)
+                return term
+        return self._log.term(idx)
+
+    def slice(self, lo: int, hi: int) -> LogSlice:
+        with self._cond:
+            durable_idx = self._durable_idx
+            unflushed = [self._unflushed(idx) for idx in range(max(lo, durable_idx + 1), min(hi, self._last_idx + 1))]
+        if lo > durable_idx:
+            result = LogSlice(lo)
+        else:
+            result = self._log.slice(lo, min(hi, durable_idx + 1))
+        result.extend(unflushed)
+        return result
+
+    def _unflushed(self, idx: int) -> Tuple[int, bytes]:
+        # must be called with self._cond held
+        if idx > self._last_idx:
+            raise IndexError('GroupCommitLog: index %d out of range' % idx)
+        pos = idx - self._durable_idx - 1
+        if pos < len(self._flushing):
+            return self._flushing[pos]
+        return self._pending[pos - len(self._flushing)]
+
+    def __iter__(self) -> Iterator[Tuple[int, bytes]]:
+        return self.iterate(self.first_idx())
+
+    def iterate(self, start_idx: int) -> Iterator[Tuple[int, bytes]]:
+        with self._cond:
+            self._quiesce()
+            records = list(self._log.iterate(start_idx))
+        return iter(records)
+
+    def close(self):
+        with self._cond:
+            self._quiesce()
+            self._log.close()
+            self._closed = True
+            self._cond.notify_all()
+
+    def get_stats(self) -> Dict[str, object]:
+        """
+        get_stats returns counters for tuning the batch size and delay:
+            batches: number of batches written
+            records: number of records written
+            batch_sizes: number of batches written, by batch size
+        plus the bytes_written and fsyncs of the underlying SegmentedLog.
+        """
+        with self._cond:
+            stats = {
+                'batches': sum(self._batch_sizes.values()),
+                'records': sum(size * count for size, count in self._batch_sizes.items()),
+                'batch_sizes': dict(self._batch_sizes),
+            }
+            stats.update(self._log.get_stats())
+        return stats
+
+
+class LRUCache(object):
+    """
+    LRUCache is a least-recently-used cache bounded by the total size of the values it holds, rather than their
+    number. The caller says how big each value is.
+    """
+
+    def __init__(self, max_bytes: int):
+        self._max_bytes: int = max_bytes
+        self._bytes: int = 0
+        self._items: collections.OrderedDict = collections.OrderedDict()  # key -> (value, size)
+        self._lock: threading.Lock = threading.Lock()
+
+    def get(self, key):
+        """
+        get returns the value cached for key, or None.
+        """
+        with self._lock:
+            try:
+                value, _ = self._items[key]
+            except KeyError:
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value, size: int):
+        with self._lock:
+            if key in self._items:
+                self._bytes -= self._items.pop(key)[1]
+            if size > self._max_bytes:
+                return
+            self._items[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self._max_bytes:
+                _, (_, evicted_size) = self._items.popitem(last=False)
+                self._bytes -= evicted_size
+
+    def discard(self, keep: Callable[[object], bool]):
+        """
+        discard drops every key for which keep(key) is false.
+        """
+        with self._lock:
+            for key in [k for k in self._items if not keep(k)]:
+                self._bytes -= self._items.pop(key)[1]
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'cached_items': len(self._items),
+                'cached_bytes': self._bytes,
+            }
+
+
+class HardStateFile(object):
+    """
+    HardStateFile stores the Raft hard state (currentTerm, votedFor and a commit index hint) as one small
+    fixed-size record:
+        <u64 term><i64 voted_for, -1 for none><u64 commit hint>
+    Every write goes to a temporary file which is fsynced and then renamed over the old one, so the record on disk is
+    always either the old or the new one, and costs the same regardless of the size of the log.
+    """
+
+    RECORD = struct.Struct('>QqQ')
+
+    def __init__(self, fpath: str, fsync: bool = True):
+        self._fpath: str = fpath
+        self._fsync: bool = fsync
+
+    def exists(self) -> bool:
+        return os.path.exists(self._fpath)
+
+    def read(self) -> Tuple[int, Optional[int], int]:
+        """
+        read returns (term, voted_for, commit_hint), or (0, None, 0) if nothing has been written yet.
+        """
+        if not self.exists():
+            return 0, None, 0
+        with open(self._fpath, 'rb') as f:
+            term, voted_for, commit_hint = HardStateFile.RECORD.unpack(f.read(HardStateFile.RECORD.size))
+        return term, (None if voted_for < 0 else voted_for), commit_hint
+
+    def write(self, term: int, voted_for: Optional[int], commit_hint: int):
+        record = HardStateFile.RECORD.pack(term, -1 if voted_for is None else voted_for, commit_hint)
+        write_atomic(self._fpath, record, self._fsync)
+
+
+class SnapshotFile(object):
+    """
+    SnapshotFile stores the latest snapshot of the state machine, taken at some applied log index:
+        <u64 last included index><u64 last included term><snapshot data>
+    It is replaced as a whole, the same way as HardStateFile.
+    """
+
+    HEADER = struct.Struct('>QQ')
+
+    def __init__(self, fpath: str, fsync: bool = True):
+        self._fpath: str = fpath
+        self._fsync: bool = fsync
+
+    def exists(self) -> bool:
+        return os.path.exists(self._fpath)
+
+    def read_header(self) -> Tuple[int, int]:
+        """
+        read_header returns (last_included_idx, last_included_term), or (0, 0) if there is no snapshot.
+        """
+        if not self.exists():
+            return 0, 0
+        with open(self._fpath, 'rb') as f:
+            return SnapshotFile.HEADER.unpack(f.read(SnapshotFile.HEADER.size))
+
+    def read(self) -> Tuple[int, int, bytes]:
+        """
+        read returns (last_included_idx, last_included_term, data), or (0, 0, b'') if there is no snapshot.
+        """
+        if not self.exists():
+            return 0, 0, b''
+        with open(self._fpath, 'rb') as f:
+            idx, term = SnapshotFile.HEADER.unpack(f.read(SnapshotFile.HEADER.size))
+            return idx, term, f.read()
+
+    def write(self, idx: int, term: int, data: bytes):
+        write_atomic(self._fpath, SnapshotFile.HEADER.pack(idx, term) + data, self._fsync)
+
+
+def write_atomic(fpath: str, data: bytes, fsync: bool = True):
+    """
+    write_atomic replaces the contents of fpath with data by writing a temporary file and renaming it over fpath.
+    """
+    tmp_fpath = fpath + '.tmp'
+    with open(tmp_fpath, 'wb') as f:
+        f.write(data)
+        f.flush()
+        if fsync:
+            os.fsync(f.fileno())
+    os.replace(tmp_fpath, fpath)
+    if fsync:
+        fd = os.open(os.path.dirname(os.path.abspath(fpath)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def hardstate_fpath(state_fpath: str) -> str:
+    """
+    hardstate_fpath returns the hard state file belonging to a persistent state file.
+    Example:
+        hardstate_fpath("/data/state_0.json") -> "/data/state_0.hardstate"
+    """
+    return os.path.splitext(state_fpath)[0] + '.hardstate'
+
+
+def snapshot_fpath(state_fpath: str) -> str:
+    """
+    snapshot_fpath returns the snapshot file belonging to a persistent state file.
+    Example:
+        snapshot_fpath("/data/state_0.json") -> "/data/state_0.snapshot"
+    """
+    return os.path.splitext(state_fpath)[0] + '.snapshot'
+
+
+def log_dirpath(state_fpath: str) -> str:
+    """
+    log_dirpath returns the segment directory belonging to a persistent state file.
+    Example:
+        log_dirpath("/data/state_0.json") -> "/data/state_0.log"
+    """
+    return os.path.splitext(state_fpath)[0] + '.log'
+
+
+def main():
+    """
+    Dumps the hard state and log belonging to a persistent state file, one "idx term payload" line per entry.
+    Example:
+        $ booking/raft_log.py data/state_0.json
+    """
+    for state_fpath in sys.argv[1:]:
+        term, voted_for, commit_hint = HardStateFile(hardstate_fpath(state_fpath)).read()
+        print("current_term:%d voted_for:%s commit_hint:%d" % (term, voted_for, commit_hint))
+        snapshot_idx, snapshot_term = SnapshotFile(snapshot_fpath(state_fpath)).read_header()
+        print("snapshot last_included_idx:%d last_included_term:%d" % (snapshot_idx, snapshot_term))
+        log = SegmentedLog(log_dirpath(state_fpath), fsync=False)
+        idx = max(log.first_idx(), snapshot_idx + 1)
+        for term, payload in log.iterate(idx):
+            print("%d %d %s" % (idx, term, payload.decode('utf-8', errors='replace')))
+            idx += 1
+        log.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -56,6 +56,43 @@ class VoteMessage(object):
         return VoteMessage(term, candidate_id, last_log_idx, last_log_term)
 
 
+class PreVoteMessage(object):
+    """
+    Invoked by a would-be candidate before starting an election, to find out whether it could win one. Answering
+    changes neither the receiver's term nor its vote (§9.6 of the Raft dissertation).
+    :param term: the term the candidate would start an election in, one past its current term
+    :param candidate_id: candidate requesting pre-vote
+    :param last_log_idx: index of candidate's last log entry
+    :param last_log_term: term of candidate's last log entry
+    :return: (current_term, vote_granted): current term for candidate to update itself
+            and whether the receiver would vote for the candidate in term
+    """
+
+    def __init__(self, term: int, candidate_id: int, last_log_idx: int, last_log_term: int):
+        self.term = term
+        self.candidate_id = candidate_id
+        self.last_log_idx = last_log_idx
+        self.last_log_term = last_log_term
+
+    def __bytes__(self):
+        return b'prevote %d %d %d %d' % (self.term, self.candidate_id, self.last_log_idx, self.last_log_term)
+
+    def __repr__(self):
+        return str(bytes(self))
+
+    @classmethod
+    def from_bytes(cls, bytes_: bytes):
+        bytes_ = bytes_.lstrip(b'prevote ')
+        parts = bytes_.split(b' ')
+        assert len(parts) == 4, 'PreVoteMessage.from_bytes expected 4 parts after stripping leading prevote but got ' \
+                                '%d' % len(parts)
+        term = int(parts.pop(0))
+        candidate_id = int(parts.pop(0))
+        last_log_idx = int(parts.pop(0))
+        last_log_term = int(parts.pop(0))
+        return PreVoteMessage(term, candidate_id, last_log_idx, last_log_term)
+
+
 class AppendEntriesMessage(object):
     """
     Invoked by leader to replicate log entries (§5.3); also used as heartbeat (§5.2).
@@ -64,46 +101,155 @@ class AppendEntriesMessage(object):
     :param prev_log_idx: index of log entry immediately preceding new ones
     :param prev_log_term: term of prev_log_idx entry
     :param leader_commit_idx: leader commit index
-    :param entry: log entry to store. May be None for heartbeat. TODO: support multiple entries at once.
+    :param entries: log entries to store, in order. Empty for heartbeat.
     :return: term, success: current term, for leader to update itself, success true if follower contained entry
             matching prev_log_idx and prev_log_term
+    Entries are sent as their count followed by each entry prefixed with its length, as entries may contain spaces:
+        append <term> <leader_id> <prev_log_idx> <prev_log_term> <leader_commit_idx> <n> <len1> <entry1> ...
     """
 
     def __init__(self, term: int, leader_id: int, prev_log_idx: int, prev_log_term: int, leader_commit_idx: int,
-                 entry: Optional['Entry']):
+                 entries: Optional[List['Entry']] = None):
         self.term: int = term
         self.leader_id: int = leader_id
         self.prev_log_idx: int = prev_log_idx
         self.prev_log_term: int = prev_log_term
         self.leader_commit_idx: int = leader_commit_idx
-        self.entry: Optional['Entry'] = entry
+        self.entries: List['Entry'] = entries or []
 
     def __bytes__(self):
-        if self.entry is None:
-            return b'append %d %d %d %d %d' % (
-                self.term, self.leader_id, self.prev_log_idx, self.prev_log_term, self.leader_commit_idx)
-        return b'append %d %d %d %d %d %s' % (
-            self.term, self.leader_id, self.prev_log_idx, self.prev_log_term, self.leader_commit_idx, self.entry)
+        parts = [b'append %d %d %d %d %d %d' % (
+            self.term, self.leader_id, self.prev_log_idx, self.prev_log_term, self.leader_commit_idx,
+            len(self.entries))]
+        for entry in self.entries:
+            entry_bytes = bytes(entry)
+            parts.append(b'%d %s' % (len(entry_bytes), entry_bytes))
+        return b' '.join(parts)
 
     def __repr__(self):
-        return str(bytes(self))
+        return 'append %d %d %d %d %d <%d entries>' % (
+            self.term, self.leader_id, self.prev_log_idx, self.prev_log_term, self.leader_commit_idx,
+            len(self.entries))
 
     @classmethod
     def from_bytes(cls, bytes_: bytes):
         bytes_ = bytes_.lstrip(b'append ')
-        parts: List[bytes] = bytes_.split(b' ', maxsplit=5)  # entry may contain spaces
-        assert len(parts) in [5, 6], 'AppendEntriesMessage.from_bytes expected either 5 or 6 parts after stripping' \
-                'leading "append" from %s but got %d' % (bytes_, len(parts))
+        parts: List[bytes] = bytes_.split(b' ', maxsplit=6)  # entries may contain spaces
+        assert len(parts) in [6, 7], 'AppendEntriesMessage.from_bytes expected either 6 or 7 parts after stripping' \
+                'leading "append" but got %d' % len(parts)
         term: int = int(parts.pop(0))
         leader_id: int = int(parts.pop(0))
         prev_log_idx: int = int(parts.pop(0))
         prev_log_term: int = int(parts.pop(0))
         leader_commit_idx: int = int(parts.pop(0))
-        try:
-            entry = Entry.from_bytes(parts.pop(0))
-        except IndexError:
-            entry = None
-        return AppendEntriesMessage(term, leader_id, prev_log_idx, prev_log_term, leader_commit_idx, entry)
+        count: int = int(parts.pop(0))
+        rest: bytes = parts.pop(0) if parts else b''
+        entries: List[Entry] = []
+        pos = 0
+        for _ in range(count):
+            sep = rest.index(b' ', pos)
+            length = int(rest[pos:sep])
+            entries.append(Entry.from_bytes(rest[sep + 1:sep + 1 + length]))
+            pos = sep + 1 + length + 1
+        return AppendEntriesMessage(term, leader_id, prev_log_idx, prev_log_term, leader_commit_idx, entries)
+
+
+class InstallSnapshotMessage(object):
+    """
+    Invoked by leader to send chunks of a snapshot to a follower. Leaders always send chunks in order (§7).
+    We always send the whole snapshot in one chunk, so there is no offset or done flag.
+    :param term: leader's term
+    :param leader_id: so follower can redirect clients
+    :param last_included_idx: the snapshot replaces all entries up through and including this index
+    :param last_included_term: term of last_included_idx
+    :param data: raw bytes of the snapshot. Must not contain newlines.
+    :return: term: current term, for leader to update itself
+    """
+
+    def __init__(self, term: int, leader_id: int, last_included_idx: int, last_included_term: int, data: bytes):
+        self.term: int = term
+        self.leader_id: int = leader_id
+        self.last_included_idx: int = last_included_idx
+        self.last_included_term: int = last_included_term
+        self.data: bytes = data
+
+    def __bytes__(self):
+        return b'install %d %d %d %d %s' % (
+            self.term, self.leader_id, self.last_included_idx, self.last_included_term, self.data)
+
+    def __repr__(self):
+        return 'install %d %d %d %d <%d bytes>' % (
+            self.term, self.leader_id, self.last_included_idx, self.last_included_term, len(self.data))
+
+    @classmethod
+    def from_bytes(cls, bytes_: bytes):
+        bytes_ = bytes_.lstrip(b'install ')
+        parts: List[bytes] = bytes_.split(b' ', maxsplit=4)  # data may contain spaces
+        assert len(parts) == 5, 'InstallSnapshotMessage.from_bytes expected 5 parts after stripping leading ' \
+                                '"install" but got %d' % len(parts)
+        term: int = int(parts.pop(0))
+        leader_id: int = int(parts.pop(0))
+        last_included_idx: int = int(parts.pop(0))
+        last_included_term: int = int(parts.pop(0))
+        data: bytes = parts.pop(0)
+        return InstallSnapshotMessage(term, leader_id, last_included_idx, last_included_term, data)
+
+
+class ReadIndexMessage(object):
+    """
+    Invoked by clients before reading from a node's database, to wait until it reflects every entry committed
+    before the read was requested (ReadIndex, §8). Followers forward it to the leader.
+    A client that can make do with a stale read sets either bound, and a node within both answers straight away.
+    :param forwarded: sent on by a follower, so the receiver must not forward it again
+    :param max_lag_entries: how many committed entries the node may not have applied yet, None for no bound
+    :param max_staleness_ms: how long ago the node may have last heard from the leader (or, for the leader, from a
+            majority of the cluster), None for no bound
+    :return: term, success, read_idx: current term, whether the read may go ahead, and the index of the last entry
+            applied to the database it is served from
+    """
+
+    def __init__(self, forwarded: bool = False, max_lag_entries: Optional[int] = None,
+                 max_staleness_ms: Optional[int] = None):
+        self.forwarded: bool = forwarded
+        self.max_lag_entries: Optional[int] = max_lag_entries
+        self.max_staleness_ms: Optional[int] = max_staleness_ms
+
+    def allows_stale(self) -> bool:
+        return self.max_lag_entries is not None or self.max_staleness_ms is not None
+
+    def __bytes__(self):
+        # -1 stands for no bound
+        return b'read %d %d %d' % (
+            self.forwarded,
+            -1 if self.max_lag_entries is None else self.max_lag_entries,
+            -1 if self.max_staleness_ms is None else self.max_staleness_ms)
+
+    def __repr__(self):
+        return str(bytes(self))
+
+    @classmethod
+    def from_bytes(cls, bytes_: bytes):
+        bytes_ = bytes_.lstrip(b'read ')
+        parts = [int(part) for part in bytes_.split(b' ')]
+        assert len(parts) in [1, 3], 'ReadIndexMessage.from_bytes expected 1 or 3 parts after stripping leading ' \
+                                     '"read" but got %d' % len(parts)
+        forwarded = parts.pop(0) == 1
+        max_lag_entries, max_staleness_ms = [None if bound < 0 else bound for bound in parts] or [None, None]
+        return ReadIndexMessage(forwarded, max_lag_entries, max_staleness_ms)
+
+
+class NoopMessage(object):
+    """
+    Log entry appended by a leader at the start of its term. Committing it commits the entries of previous terms
+    before it (§5.4.2), and tells the leader its commit index is up to date, as needed to serve reads (§8).
+    It has no effect on the database.
+    """
+
+    def __bytes__(self):
+        return b'noop'
+
+    def __repr__(self):
+        return str(bytes(self))
 
 
 class DbEntriesMessage(object):
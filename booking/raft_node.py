@@ -1,17 +1,24 @@
 #!/usr/bin/env python
+import concurrent.futures
+import functools
 import inspect
+import json
 import logging
+import math
 import random
 import sqlite3
 import threading
 import time
 from typing import List, Optional, Dict, Callable, Tuple
 
-from raft_messages import AppendEntriesMessage, VoteMessage, DbEntriesMessage
+from raft_messages import AppendEntriesMessage, VoteMessage, DbEntriesMessage, InstallSnapshotMessage, \
+    ReadIndexMessage, NoopMessage, PreVoteMessage
 from raft_state_machine import StateMachine, DummyStateMachine
 from raft_peer import Peer
 from raft_rpc_client import RpcClient
 from raft_rpc_server import RpcServer
+from raft_scheduler import Scheduler, Timer
+from raft_log import LogSlice
 from raft_states import NodePersistentState, NodeVolatileState, LeaderVolatileState, Entry
 import operation
 
@@ -43,6 +50,21 @@ class NoisyLock(object):
         self._lock.__exit__(exc_type, exc_val, exc_tb)
 
 
+class Proposal(concurrent.futures.Future):
+    """
+    A command proposed to the leader. Resolved with the state machine's result once its entry is applied, or with a
+    RuntimeError if it will not be applied as ours: if we were not the leader, or stopped leading before applying it,
+    in which case another leader may still commit it.
+    """
+
+    def __init__(self, data: bytes):
+        super().__init__()
+        self.data: bytes = data
+        # where the entry is in our log, once appended
+        self.log_idx: Optional[int] = None
+        self.term: Optional[int] = None
+
+
 class Node(object):
     STATE_FOLLOWER = 0
     STATE_CANDIDATE = 1
@@ -51,7 +73,10 @@ class Node(object):
     def __init__(self, node_id: int, persistent_state: 'NodePersistentState', peers: List[Peer],
                  dbconn: sqlite3.Connection,
                  election_timeout_ms_min: int = 3000, election_timeout_ms_max: int = 6000,
-                 loop_interval_ms: int = 1000):
+                 loop_interval_ms: int = 1000, snapshot_threshold: int = 1000,
+                 max_append_entries: int = 64, max_append_bytes: int = 32 * 1024, replication_window: int = 1,
+                 apply_batch_size: int = 256, lease_reads: bool = False, lease_margin_ms: Optional[int] = None,
+                 proposal_batch_ms: int = 2, rpc_workers: int = 8, pre_vote: bool = True):
         LOG.debug("Node init node_id: %d peers:%s persistent_state: %s", node_id, peers, persistent_state._fpath)
         self._node_id: int = node_id
         self._host = None
@@ -61,184 +86,499 @@ class Node(object):
         self._leader_volatile_state: Optional[LeaderVolatileState] = None
         self._peers: List[Peer] = peers
         self._server: Optional[RpcServer] = None
-        self._client: RpcClient = RpcClient()
+        # a peer that does not answer within an election timeout is as good as down
+        self._client: RpcClient = RpcClient(timeout=election_timeout_ms_max / 1000)
+        # drives elections and heartbeats, on the thread that calls start(). RPCs to peers block, so they are sent
+        # from a pool of rpc_workers threads, however many peers there are. A peer that does not answer holds up to
+        # replication_window + 2 of them, until the client times out
+        self._scheduler: Scheduler = Scheduler()
+        # set by stop(), for the applier and the proposer to return, and RPCs queued before to be dropped
+        self._stopped: bool = False
+        self._applier: Optional[threading.Thread] = None
+        self._proposer: Optional[threading.Thread] = None
+        self._rpc_pool: concurrent.futures.ThreadPoolExecutor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=rpc_workers)
+        # starts elections, which write our term to disk, off the scheduler. Apart from the RPC pool, which peers that
+        # do not answer may hold up for an election timeout
+        self._election_pool: concurrent.futures.ThreadPoolExecutor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1)
         self._state: int = Node.STATE_FOLLOWER
         self._lock: threading.Lock = threading.Lock()
         # self._lock: NoisyLock = NoisyLock()
+        # wakes whoever waits for what replication brings: replies received, the commit index advancing while we
+        # lead, or a change of role
+        self._replication_cond: threading.Condition = threading.Condition(self._lock)
+        # wakes the applier when the commit index advances
+        self._commit_cond: threading.Condition = threading.Condition(self._lock)
+        # wakes whoever waits for entries to be applied
+        self._applied_cond: threading.Condition = threading.Condition(self._lock)
+        # wakes the proposer when a batch of proposals starts, and once it is full
+        self._proposal_cond: threading.Condition = threading.Condition(self._lock)
+        # proposals waiting to be appended to our log together, since when, on the monotonic clock, and those
+        # appended but not applied yet, by log index
+        self._proposals: List[Proposal] = []
+        self._proposals_since: float = 0
+        self._proposed: Dict[int, Proposal] = {}
+        # how long the proposer waits after the first proposal of a batch for more to append with it
+        self._proposal_batch_ms: int = proposal_batch_ms
+        self._proposal_stats: Dict[str, int] = {'proposals': 0, 'batches': 0}
+        # rounds of heartbeats confirming our leadership for reads: the latest one started, and the latest one wanted
+        self._read_seq: int = 0
+        self._read_wanted: int = 0
+        # serve reads without a round of heartbeats while a majority has acked one recently enough that no other
+        # leader can have been elected since. The lease is cut short by lease_margin_ms, for clocks running apart
+        self._lease_reads: bool = lease_reads
+        self._lease_margin_ms: int = election_timeout_ms_min // 10 if lease_margin_ms is None else lease_margin_ms
+        # when we last heard from a leader, on the monotonic clock, and the highest commit index it told us of
+        self._leader_contact: Optional[float] = None
+        self._leader_commit_idx: int = 0
+        # when we started, on the monotonic clock: _leader_contact does not survive a restart, so until a minimum
+        # election timeout has passed since, we may have heard from a leader just before it for all we know
+        self._started_at: Optional[float] = None
         self._dbconn: sqlite3.Connection = dbconn
-        self._should_step_down: bool = False
-        self._election_timeout_ms = None  # set below
+        # serializes our transactions on dbconn; taken after self._lock when both are needed
+        self._db_lock: threading.Lock = threading.Lock()
+        # when, on the monotonic clock, we start an election unless we hear from a leader or grant a vote first, and
+        # the timer that checks it
+        self._election_deadline: float = 0
+        self._election_timer: Optional[Timer] = None
         self._election_timeout_ms_min: int = election_timeout_ms_min
         self._election_timeout_ms_max: int = election_timeout_ms_max
+        # ask the peers whether they would vote for us before starting an election, and the current round of asking
+        self._pre_vote: bool = pre_vote
+        self._pre_vote_round: int = 0
+        self._pre_votes: int = 0
+        self._election_stats: Dict[str, int] = {'pre_votes': 0, 'elections': 0}
+        # how often the leader sends heartbeats, and candidates retry peers that did not answer
         self._loop_interval_ms: int = loop_interval_ms
+        if loop_interval_ms >= election_timeout_ms_min:
+            LOG.warning("Node: loop_interval_ms:%d is not below election_timeout_ms_min:%d, followers will start "
+                        "elections while the leader is alive", loop_interval_ms, election_timeout_ms_min)
+        # take a snapshot once this many entries have been applied since the last one (0 disables snapshots)
+        self._snapshot_threshold: int = snapshot_threshold
+        # limits on the entries sent in a single AppendEntries message (at least one entry is always sent)
+        self._max_append_entries: int = max_append_entries
+        self._max_append_bytes: int = max_append_bytes
+        # number of AppendEntries messages kept in flight to each follower; 1 waits for each reply before sending more
+        self._replication_window: int = replication_window
+        # most committed entries applied to the database in a single transaction
+        self._apply_batch_size: int = apply_batch_size
+        self._apply_stats: Dict[str, float] = {'entries': 0, 'batches': 0, 'seconds': 0.0}
+        # reads answered from our database as it was, within the staleness the client allowed, and through ReadIndex
+        self._read_stats: Dict[str, int] = {'local': 0, 'read_index': 0}
         self._votes = 0
         self._leader_id: int = None
+        # entries up to the snapshot, and up to the index recorded with the last database update,
+        # were applied before a restart, and entries up to the commit hint were known to be committed
+        operation.create_applied_table(dbconn)
+        snapshot_idx, _ = persistent_state.get_snapshot()
+        last_log_idx, _ = persistent_state.get_last_log()
+        last_applied = max(snapshot_idx, operation.get_last_applied(dbconn))
+        self._node_volatile_state.set_last_applied(last_applied)
+        self._node_volatile_state.set_commit_idx(max(last_applied, min(persistent_state.get_commit_hint(),
+                                                                       last_log_idx)))
 
     def start(self, host: str, port: int):
         LOG.debug("Node start host:%s port:%d", host, port)
-        self.reset_election_timeout()
         with self._lock:
+            self._started_at = time.monotonic()
+            self.reset_election_timeout()
             handlers: Dict[bytes, Callable] = {
                 b'vote': self.handle_request_vote,
+                b'prevote': self.handle_pre_vote,
                 b'append': self.handle_append_entries,
+                b'install': self.handle_install_snapshot,
                 b'db': self.handle_database_request,
                 b'state': self.handle_state_request,
+                b'read': self.handle_read_index,
             }
             self._host = host
             self._port = port
             self._server = RpcServer(host, port, handlers)
             self._server.start()
 
-        self.loop_forever()
+        self._applier = threading.Thread(target=self.apply_forever)
+        self._applier.daemon = True
+        self._applier.start()
+        self._proposer = threading.Thread(target=self.propose_forever)
+        self._proposer.daemon = True
+        self._proposer.start()
+        self._scheduler.run()
 
     def stop(self):
+        """
+        Stops the node for good: it no longer sends or answers RPCs, its threads return, and its persistent state is
+        closed. RPCs already being sent may still be.
+        """
         LOG.debug("Node stop")
         with self._lock:
+            if self._stopped:
+                return
+            self._stopped = True
+            # no more heartbeats or replication, and proposals waiting on us fail
+            self.set_state(Node.STATE_FOLLOWER)
+            self._commit_cond.notify_all()
+            self._proposal_cond.notify_all()
+        self._scheduler.stop()
+        # takes up to its poll interval, which must not hold up the handlers still running
+        if self._server is not None:
             self._server.stop()
-
-    def loop_forever(self):
-        LOG.debug("Node looping forever")
-        while True:
-            self.do_regular()
-            self.do_follower()
-            self.do_candidate()
-            time.sleep(self._loop_interval_ms / 1000)
-            if not self.is_leader():
-                self.decrease_election_timeout()
-
-    def do_regular(self):
-        with self._lock:
-            if self._should_step_down:
-                LOG.debug("Node do_regular: stepping down")
-                self._state = Node.STATE_FOLLOWER
-                self._should_step_down = False
-
-            curr_commit_idx = self._node_volatile_state.get_commit_idx()
-            while True:
-                curr_last_applied = self._node_volatile_state.get_last_applied()
-                LOG.debug("Node do_regular commit_idx:%d last_applied:%d", curr_commit_idx, curr_last_applied)
-                if curr_commit_idx > curr_last_applied:
-                    entries = self._node_persistent_state.get_logs()
-                    print(entries)
-                    if not entries:
-                        LOG.debug("Can't work with empty logs")
-                        break
-                    curr_last_applied += 1
-                    entry: Entry = self._node_persistent_state.get_logs()[curr_last_applied - 1]
-                    db_msg = DbEntriesMessage.from_bytes(entry._data)
-                    operation.update(self._dbconn, "room", db_msg.room)
-                    self._node_volatile_state.set_last_applied(curr_last_applied)
-                else:
-                    break
-
-    def do_follower(self):
-        if not self.is_follower():
-            return
-
-        # if election timeout elapses without receiving AppendEntries RPC from current leader
-        # or granting vote to candidate: convert to candidate.
-        if self.get_election_timeout_ms() <= 0:
-            self.become_candidate()
-
-    def do_candidate(self):
-        if not self.is_candidate():
-            return
-
+        self._rpc_pool.shutdown(wait=False)
+        self._election_pool.shutdown(wait=False)
+        for thread in [self._applier, self._proposer]:
+            if thread is not None:
+                thread.join()
+        self._node_persistent_state.close()
+
+    def election_timer(self):
+        """
+        Runs on the scheduler when the election timeout may have elapsed. If it has, and we do not lead: has an
+        election started from the election pool (§5.2), as that writes our term to disk, which would hold up the
+        heartbeats due meanwhile. Nothing is timed while we lead: stepping down restarts the election timeout.
+        """
         with self._lock:
-            if self._should_step_down:
-                LOG.info("stepping down from candidate to follower")
-                self._state = Node.STATE_FOLLOWER
-                self._should_step_down = False
+            self._election_timer = None
+            if self._state == Node.STATE_LEADER:
                 return
+            if time.monotonic() >= self._election_deadline:
+                # If election timeout elapses without receiving AppendEntries RPC from current leader or granting
+                # vote to candidate: convert to candidate. A candidate starts a new election (§5.2). Starting one
+                # restarts the election timeout, which schedules us again
+                self._election_pool.submit(self.start_pre_vote)
+            else:
+                self.schedule_election_timer(self._election_deadline)
 
-        # if election timeout elapses: start new election
-        if self.get_election_timeout_ms() <= 0:
-            self.become_candidate()
-
-    def sync_peer(self, peer):
+    def reset_election_timeout(self):
+        """
+        Restarts the election timeout, with a new random duration between election_timeout_ms_min and
+        election_timeout_ms_max. Must be called with self._lock held.
+        """
+        timeout_ms = random.randint(self._election_timeout_ms_min, self._election_timeout_ms_max)
+        self._election_deadline = time.monotonic() + timeout_ms / 1000
+        LOG.debug("election timeout reset: %dms", timeout_ms)
+        self.schedule_election_timer(self._election_deadline)
+
+    def schedule_election_timer(self, when: float):
+        """
+        Has election_timer run at when, on the monotonic clock, unless it is due to run before then already: resets
+        only push the deadline back, so the timer is not rescheduled on every heartbeat, and when it finds that the
+        deadline has moved, it runs again at the new one. Must be called with self._lock held.
+        """
+        if self._election_timer is not None:
+            if self._election_timer.when <= when:
+                return
+            self._election_timer.cancel()
+        self._election_timer = self._scheduler.call_at(when, self.election_timer)
+
+    def apply_forever(self):
+        """
+        Applies committed entries to the database as soon as the commit index moves past them, up to
+        apply_batch_size of them at a time in a single transaction. The database is written without holding
+        self._lock, so that RPCs are handled meanwhile.
+        """
+        LOG.debug("Node applying forever")
         while True:
-            start_ms: int = int(time.time() * 1000)
             with self._lock:
-                if self._state != Node.STATE_LEADER:
-                    LOG.info("node_id:%d sync_peer: no longer leader, stopping", self._node_id)
-                    return
-                # If last log index ≥ nextIndex for a follower: send
-                # AppendEntries RPC with log entries starting at nextIndex
-                all_logs: List[Entry] = self._node_persistent_state.get_logs()
-                if len(all_logs) == 0:
-                    return  # nothing to replicate
-
-                current_term = self._node_persistent_state.get_term()
-                commit_idx = self._node_volatile_state.get_commit_idx()
-                peer_next_idx: int = self._leader_volatile_state.get_next_idx(peer)
-                LOG.debug("sync_peer:%s current_term:%d commit_idx:%d peer_next_idx:%d",
-                          peer, current_term, commit_idx, peer_next_idx)
-                if len(all_logs) <= peer_next_idx:
-                    return False  # peer is up to date as far as we can tell
-
-                # if we get here, need to replicate logs from nextIndex onwards
-                # for now, just doing one at a time
-                next_log_to_replicate = all_logs[peer_next_idx - 1]
-                prev_log_idx = peer_next_idx - 1
-                prev_log_term = all_logs[prev_log_idx]._term
-                msg: AppendEntriesMessage = AppendEntriesMessage(
-                    current_term,
-                    self._node_id,
-                    prev_log_idx,
-                    prev_log_term,
-                    commit_idx,
-                    next_log_to_replicate,
-                )
-                _, ok = self._client.send(peer, msg)
-                if ok:
-                    # If successful: update nextIndex and matchIndex for
-                    # follower (§5.3)
-                    self._leader_volatile_state.set_next_idx(peer, peer_next_idx + 1)
-                    self._leader_volatile_state.set_match_idx(peer, peer_next_idx)
-                    return
-                else:
-                    # If AppendEntries fails because of log inconsistency:
-                    # decrement nextIndex and retry (§5.3)
-                    self._leader_volatile_state.set_next_idx(peer, max(0, peer_next_idx - 1))
-            elapsed_ms: int = start_ms - int(time.time() * 1000)
-            delta = max(0, self._loop_interval_ms - elapsed_ms)
-            time.sleep(delta / 1000)
-
-    def get_election_timeout_ms(self):
-        with self._lock:
-            return self._election_timeout_ms
+                while True:
+                    if self._stopped:
+                        return
+                    curr_commit_idx = self._node_volatile_state.get_commit_idx()
+                    self._node_persistent_state.set_commit_hint(curr_commit_idx)
+                    curr_last_applied = self._node_volatile_state.get_last_applied()
+                    LOG.debug("Node apply_forever commit_idx:%d last_applied:%d", curr_commit_idx, curr_last_applied)
+                    if curr_commit_idx > curr_last_applied:
+                        # If commitIndex > lastApplied: increment lastApplied, apply
+                        # log[lastApplied] to state machine (§5.3)
+                        entries: LogSlice = self._node_persistent_state.get_log_slice(
+                            curr_last_applied + 1, min(curr_commit_idx, curr_last_applied + self._apply_batch_size) + 1)
+                        if len(entries) > 0:
+                            break
+                        LOG.debug("Node apply_forever: no entries after idx:%d yet", curr_last_applied)
+                    self._commit_cond.wait()
 
-    def decrease_election_timeout(self):
+            try:
+                results = self.apply_entries(entries)
+            except Exception as e:
+                # the entries are committed, so they must be applied, and in order: try them again in a while
+                LOG.exception("Node apply_forever: %s, retrying in %dms", e, self._loop_interval_ms)
+                time.sleep(self._loop_interval_ms / 1000)
+                continue
+            with self._lock:
+                self.resolve_proposals(entries, results)
+                self._applied_cond.notify_all()
+            self.maybe_snapshot()
+
+    def apply_entries(self, entries: LogSlice) -> Optional[Dict[int, Optional[int]]]:
+        """
+        Applies entries, which follow the last applied entry, to the database in a single transaction, together with
+        the new last applied index.
+        :return: the result of applying each entry, by log index, as for operation.update, or None if the entries
+                 were not applied because a snapshot replaced them. An entry that cannot be decoded has no effect,
+                 and its result is None, as for a room that could not be booked
+        :raises RuntimeError: if the transaction failed, leaving lastApplied where it was
+        """
+        start = time.time()
+        noop = bytes(NoopMessage())
+        idxs: List[int] = []
+        rooms: List[int] = []
+        undecodable: List[int] = []
+        for idx, (_, data) in enumerate(entries, entries.first_idx):
+            if data == noop:
+                continue
+            try:
+                room = DbEntriesMessage.from_bytes(data).room
+            except ValueError as e:
+                # committed everywhere alike, so every node skips it alike
+                LOG.error("Node apply_entries: cannot decode entry %d %r: %s", idx, data, e)
+                undecodable.append(idx)
+                continue
+            idxs.append(idx)
+            rooms.append(room)
+        with self._db_lock:
+            # lastApplied only changes with self._db_lock held, here or when a snapshot is installed
+            if self._node_volatile_state.get_last_applied() != entries.first_idx - 1:
+                LOG.info("Node apply_entries: a snapshot was installed, not applying entries %d..%d",
+                         entries.first_idx, entries.last_idx())
+                return None
+            results = operation.update_many(self._dbconn, "room", rooms, last_applied=entries.last_idx())
+            if results is None:
+                raise RuntimeError('failed to apply entries %d..%d' % (entries.first_idx, entries.last_idx()))
+            self._node_volatile_state.set_last_applied(entries.last_idx())
+        self._apply_stats['entries'] += len(entries)
+        self._apply_stats['batches'] += 1
+        self._apply_stats['seconds'] += time.time() - start
+        applied: Dict[int, Optional[int]] = dict(zip(idxs, results))
+        applied.update((idx, None) for idx in undecodable)
+        return applied
+
+    def resolve_proposals(self, entries: LogSlice, results: Optional[Dict[int, Optional[int]]]):
+        """
+        Resolves the proposals whose entries were just applied, with the results of applying them.
+        Must be called with self._lock held.
+        """
+        if not self._proposed:
+            return
+        for idx, (term, _) in enumerate(entries, entries.first_idx):
+            proposal = self._proposed.pop(idx, None)
+            if proposal is None:
+                continue
+            if term != proposal.term:
+                proposal.set_exception(RuntimeError('entry %d was replaced by one from term %d' % (idx, term)))
+            elif results is None:
+                proposal.set_exception(RuntimeError('entry %d was replaced by a snapshot' % idx))
+            else:
+                proposal.set_result(results.get(idx))
+
+    def maybe_snapshot(self):
+        """
+        Takes a snapshot of the room table once snapshot_threshold entries have been applied since the last one,
+        discarding the log entries it covers. The table is dumped with the locks held, but the snapshot is written
+        without them, so that RPCs are handled meanwhile.
+        """
         with self._lock:
-            self._election_timeout_ms = max(0, self._election_timeout_ms - self._loop_interval_ms)
-            LOG.debug("election timeout: %d", self._election_timeout_ms)
+            last_applied = self._node_volatile_state.get_last_applied()
+            snapshot_idx, _ = self._node_persistent_state.get_snapshot()
+            if self._snapshot_threshold <= 0 or last_applied - snapshot_idx < self._snapshot_threshold:
+                return
 
-    def reset_election_timeout(self):
+            with self._db_lock:
+                # the applier may have moved on since
+                last_applied = self._node_volatile_state.get_last_applied()
+                rows = operation.dump(self._dbconn, "room")
+            if rows is None:
+                LOG.warning("maybe_snapshot: unable to dump database, not taking a snapshot")
+                return
+            last_applied_term = self._node_persistent_state.get_log_term(last_applied)
+        LOG.info("node_id:%d taking snapshot at idx:%d term:%d", self._node_id, last_applied, last_applied_term)
+        if not self._node_persistent_state.write_snapshot(last_applied, last_applied_term,
+                                                          bytes(json.dumps(rows), encoding='utf-8')):
+            return
         with self._lock:
-            self._election_timeout_ms = random.randint(self._election_timeout_ms_min, self._election_timeout_ms_max)
-            LOG.debug("election timeout reset: %d", self._election_timeout_ms)
-
-    def handle_append_entries(self, bytes_: bytes) -> Tuple[int, bool]:
+            # unless a snapshot from the leader was installed meanwhile
+            self._node_persistent_state.compact_snapshot(last_applied, last_applied_term)
+
+    def notify_replication(self):
+        """
+        Wakes whoever waits on replication, and if we lead, sends the peers whatever there is to send: fills each
+        peer's replication window, keeping up to replication_window messages in flight. nextIndex is advanced as soon
+        as a batch is sent, and rolled back if the peer rejects one, so throughput is not bound by a round trip per
+        batch. With a window of 1, the next batch is sent as soon as the reply to the previous one arrives.
+        Replies may arrive out of order, as each message goes over its own connection. An unreachable peer is retried
+        once it answers a heartbeat. Must be called with self._lock held; the messages are sent from the RPC pool.
+        """
+        self._replication_cond.notify_all()
+        if self._state != Node.STATE_LEADER:
+            return
+        leader_state = self._leader_volatile_state
+        for peer in self._peers:
+            for send in self.fill_window(peer):
+                self._rpc_pool.submit(self.send_pipelined, leader_state, peer, *send)
+
+    def fill_window(self, peer) -> List[Tuple[object, int, int, int]]:
+        """
+        Builds the messages to send to peer to fill its replication window, advancing its nextIndex past them.
+        Must be called with self._lock held.
+        :return: for each message: (message, index of the first and of the last entry it covers, nextIndex to go
+                 back to if the peer rejects it)
+        """
+        sends = []
+        current_term = self._node_persistent_state.get_term()
+        commit_idx = self._node_volatile_state.get_commit_idx()
+        last_log_idx, _ = self._node_persistent_state.get_last_log()
+        snapshot_idx, snapshot_term = self._node_persistent_state.get_snapshot()
+        in_flight = self._leader_volatile_state.get_in_flight(peer)
+        while in_flight < self._replication_window:
+            peer_next_idx: int = self._leader_volatile_state.get_next_idx(peer)
+            if last_log_idx < peer_next_idx:
+                break
+            if peer_next_idx <= snapshot_idx:
+                # the entries the peer needs have been discarded, so send it our snapshot instead (§7). It takes up
+                # the whole window, so wait for what is in flight first
+                if in_flight > 0:
+                    break
+                # the snapshot file may be newer than snapshot_idx, for the entries it covers to be discarded
+                snapshot_idx, snapshot_term, data = self._node_persistent_state.read_snapshot()
+                msg = InstallSnapshotMessage(current_term, self._node_id, snapshot_idx, snapshot_term, data)
+                sends.append((msg, peer_next_idx, snapshot_idx, peer_next_idx))
+                self._leader_volatile_state.set_next_idx(peer, snapshot_idx + 1)
+                in_flight = self._replication_window
+                break
+            entries: List[Entry] = self.entries_to_send(peer_next_idx)
+            prev_log_idx = peer_next_idx - 1
+            msg = AppendEntriesMessage(current_term, self._node_id, prev_log_idx,
+                                       self._node_persistent_state.get_log_term(prev_log_idx), commit_idx, entries)
+            # If AppendEntries fails because of log inconsistency: decrement nextIndex and retry (§5.3)
+            sends.append((msg, peer_next_idx, prev_log_idx + len(entries), max(1, prev_log_idx)))
+            self._leader_volatile_state.set_next_idx(peer, peer_next_idx + len(entries))
+            self._leader_volatile_state.set_commit_sent(peer, commit_idx)
+            in_flight += 1
+        peer_next_idx = self._leader_volatile_state.get_next_idx(peer)
+        if not sends and in_flight == 0 and peer_next_idx > snapshot_idx and \
+                self._leader_volatile_state.get_commit_sent(peer) < commit_idx:
+            # the peer has all our entries, but not the news that they are committed: tell it now rather than with
+            # the next heartbeat, so that it applies them straight away
+            prev_log_idx = peer_next_idx - 1
+            msg = AppendEntriesMessage(current_term, self._node_id, prev_log_idx,
+                                       self._node_persistent_state.get_log_term(prev_log_idx), commit_idx)
+            sends.append((msg, peer_next_idx, prev_log_idx, max(1, prev_log_idx)))
+            self._leader_volatile_state.set_commit_sent(peer, commit_idx)
+            in_flight += 1
+        self._leader_volatile_state.set_in_flight(peer, in_flight)
+        return sends
+
+    def send_pipelined(self, leader_state: LeaderVolatileState, peer, msg, first_idx: int, last_idx: int,
+                       rollback_idx: int):
+        """
+        Sends one message built by fill_window while we led with leader_state, and updates the peer's replication
+        state with the reply.
+        """
+        if self._stopped:
+            # queued before we stopped
+            return
+        their_term = None
+        conflict_term, conflict_idx = 0, 0
+        sent_at = time.monotonic()
+        try:
+            if isinstance(msg, AppendEntriesMessage):
+                their_term, ok, conflict_term, conflict_idx = self._client.send_append_entries(peer, msg)
+            else:
+                their_term, ok = self._client.send(peer, msg)
+        except Exception as e:
+            LOG.warning("send_pipelined: peer:%s exception:%s", peer, e)
+            ok = None
+        with self._lock:
+            if their_term is not None and self.maybe_step_down(their_term):
+                return
+            if self._leader_volatile_state is not leader_state or self._state != Node.STATE_LEADER:
+                return  # the reply is to a previous term of ours
+            if ok is not None:
+                leader_state.set_acked_at(peer, max(leader_state.get_acked_at(peer), sent_at))
+            slots = self._replication_window if isinstance(msg, InstallSnapshotMessage) else 1
+            leader_state.set_in_flight(peer, max(0, leader_state.get_in_flight(peer) - slots))
+            if ok:
+                # If successful: update nextIndex and matchIndex for follower (§5.3)
+                leader_state.set_match_idx(peer, max(leader_state.get_match_idx(peer), last_idx))
+                leader_state.set_next_idx(peer, max(leader_state.get_next_idx(peer), last_idx + 1))
+                self.maybe_advance_commit_idx()
+            else:
+                # resend from where the peer's log diverges, or whatever did not get there
+                if ok is False:
+                    retry_idx = self.next_idx_after_rejection(rollback_idx, conflict_term, conflict_idx)
+                else:
+                    retry_idx = first_idx
+                leader_state.set_next_idx(peer, min(leader_state.get_next_idx(peer), retry_idx))
+            if ok is not None:
+                # send more, or retry from the rolled back nextIndex, straight away. An unreachable peer is retried
+                # once it answers a heartbeat
+                self.notify_replication()
+
+    def next_idx_after_rejection(self, rollback_idx: int, conflict_term: int, conflict_idx: int) -> int:
+        """
+        Returns the nextIndex to resume from for a peer that rejected an AppendEntries, given the conflict hint in
+        its reply. rollback_idx is where to resume without a hint, one entry back from the rejected prev_log_idx.
+        If we have entries of conflict_term, the peer's log may match ours up to our last one of them; otherwise it
+        diverges from conflict_idx, where the peer's entries of that term start. Must be called with self._lock held.
+        """
+        if conflict_idx <= 0:
+            return rollback_idx
+        next_idx = conflict_idx
+        if conflict_term > 0:
+            snapshot_idx, _ = self._node_persistent_state.get_snapshot()
+            last_idx = self._node_persistent_state.get_last_idx_up_to_term(conflict_term)
+            if last_idx >= snapshot_idx and self._node_persistent_state.get_log_term(last_idx) == conflict_term:
+                next_idx = last_idx + 1
+        return max(1, min(rollback_idx, next_idx))
+
+    def entries_to_send(self, start_idx: int) -> List[Entry]:
+        """
+        Returns the entries from start_idx onwards that fit in one AppendEntries message, as limited by
+        max_append_entries and max_append_bytes. Must be called with self._lock held.
+        """
+        entries: LogSlice = self._node_persistent_state.get_log_slice(start_idx,
+                                                                      start_idx + max(1, self._max_append_entries))
+        batch: List[Entry] = []
+        size = 0
+        for term, data in entries:
+            size += len(data)
+            if batch and size > self._max_append_bytes:
+                break
+            batch.append(Entry(term, data))
+        return batch
+
+    def handle_append_entries(self, bytes_: bytes) -> Tuple[int, bool, int, int]:
+        """
+        :return: (current_term, success, conflict_term, conflict_idx). On a log mismatch, conflict_term is the term
+                 of our entry at prev_log_idx (0 if we have none) and conflict_idx the first index we hold of that
+                 term (or the index after our last entry), so that the leader can skip a whole term per round trip
+                 instead of a single entry.
+        """
         LOG.debug("Node handle_append_entries bytes:%s", bytes_)
         with self._lock:
-            if self._state == Node.STATE_LEADER:
-                LOG.warning("node_id:%s is leader but got AppendEntries, stepping down", self._node_id)
-                self._state = Node.STATE_FOLLOWER
-
-            # if we get an AppendEntries message, reset election timeout and remember who's the boss
-            self._election_timeout_ms = random.randint(self._election_timeout_ms_min, self._election_timeout_ms_max)
-            LOG.debug("got AppendEntries msg: election timeout reset: %d", self._election_timeout_ms)
-
             msg: AppendEntriesMessage = AppendEntriesMessage.from_bytes(bytes_)
             LOG.debug(
                 "node_id:%s AppendEntriesMessage term:%d leader_id:%d prev_log_idx:%d prev_log_term:%d " +
-                "leader_commit_idx:%d entry:%s",
+                "leader_commit_idx:%d entries:%d",
                 self._node_id, msg.term, msg.leader_id, msg.prev_log_idx, msg.prev_log_term, msg.leader_commit_idx,
-                msg.entry)
+                len(msg.entries))
             current_term: int = self._node_persistent_state.get_term()
             # Reply false if term < currentTerm (§5.1)
-            if msg.term < self._node_persistent_state.get_term():
-                return current_term, False
+            # A leader of a term since replaced, e.g. one rejoining the cluster, neither deposes us nor holds off
+            # our next election
+            if msg.term < current_term:
+                return current_term, False, 0, 0
+
+            # If AppendEntries RPC received from new leader: convert to follower (§5.2). A candidate that hears from
+            # the leader of its own term lost the election, and must neither keep asking for votes nor grant its own
+            if self._state == Node.STATE_CANDIDATE:
+                LOG.info("node_id:%s lost the election to node_id:%d, becoming follower", self._node_id, msg.leader_id)
+                self.set_state(Node.STATE_FOLLOWER)
+            elif self._state == Node.STATE_LEADER:
+                LOG.warning("node_id:%s is leader but got AppendEntries from node_id:%d in term:%d, stepping down",
+                            self._node_id, msg.leader_id, msg.term)
+                self.set_state(Node.STATE_FOLLOWER)
+
+            # if we get an AppendEntries message, reset election timeout and remember who's the boss
+            self.reset_election_timeout()
 
             # If RPC request or response contains term T > currentTerm:
             # set currentTerm = T, convert to follower (§5.1)
@@ -247,39 +587,93 @@ class Node(object):
                 current_term = msg.term
                 self._node_persistent_state.set_term(current_term)
 
-            # if we have no entry it is just a heartbeat
-            if msg.entry is None:
-                self._leader_id = int(msg.leader_id)
-                self._node_volatile_state.set_commit_idx(msg.leader_commit_idx)
-                return current_term, True
+            self._leader_id = int(msg.leader_id)
+            self._leader_contact = time.monotonic()
+            self._leader_commit_idx = max(self._leader_commit_idx, msg.leader_commit_idx)
 
-            existing_logs: List[Entry] = self._node_persistent_state.get_logs()
             # Reply false if log doesn’t contain an entry at prevLogIndex whose term matches prevLogTerm (§5.3)
-            if len(existing_logs) > 0:
-                try:
-                    LOG.debug("length of logs: %d", len(existing_logs))
-                    existing_entry = existing_logs[msg.prev_log_idx - 1]
-                except IndexError:
-                    LOG.debug('handle_append_entries: node_id:%d idx:%d out of range', self._node_id,
-                              msg.prev_log_idx)
-                    return current_term, False
+            last_log_idx, _ = self._node_persistent_state.get_last_log()
+            LOG.debug("last log idx: %d", last_log_idx)
+            if msg.prev_log_idx > last_log_idx:
+                LOG.debug('handle_append_entries: node_id:%d idx:%d out of range', self._node_id, msg.prev_log_idx)
+                return current_term, False, 0, last_log_idx + 1
+
+            # entries covered by our snapshot are committed, so they match the leader's log
+            snapshot_idx, _ = self._node_persistent_state.get_snapshot()
+            if msg.prev_log_idx >= snapshot_idx and \
+                    self._node_persistent_state.get_log_term(msg.prev_log_idx) != msg.prev_log_term:
+                conflict_term = self._node_persistent_state.get_log_term(msg.prev_log_idx)
+                conflict_idx = max(snapshot_idx + 1,
+                                   self._node_persistent_state.get_last_idx_up_to_term(conflict_term - 1) + 1)
+                # If an existing entry conflicts with a new one (same index but different terms),
+                # delete the existing entry and all that follow it (§5.3)
+                self._node_persistent_state.delete_logs_from(msg.prev_log_idx)
+                LOG.debug('handle_append_entries: node_id:%d did not find existing entry with idx:%d, '
+                          'conflict_term:%d conflict_idx:%d', self._node_id, msg.prev_log_idx, conflict_term,
+                          conflict_idx)
+                return current_term, False, conflict_term, conflict_idx
+
+            # Skip the entries we already have. If an existing entry conflicts with a new one (same index but
+            # different terms), delete the existing entry and all that follow it (§5.3)
+            first_new = 0
+            while first_new < len(msg.entries):
+                idx = msg.prev_log_idx + 1 + first_new
+                if idx > last_log_idx:
+                    break
+                if idx > snapshot_idx and \
+                        self._node_persistent_state.get_log_term(idx) != msg.entries[first_new]._term:
+                    self._node_persistent_state.delete_logs_from(idx)
+                    break
+                first_new += 1
+            # Append any new entries not already in the log, with a single write
+            if first_new < len(msg.entries):
+                self._node_persistent_state.append_logs(msg.entries[first_new:])
+            # If leaderCommit > commitIndex, set commitIndex = min(leaderCommit, index of last new entry)
+            last_new_idx = msg.prev_log_idx + len(msg.entries)
+            if msg.leader_commit_idx > self._node_volatile_state.get_commit_idx():
+                self.advance_commit_idx(min(msg.leader_commit_idx, last_new_idx))
 
-                if existing_entry._term != msg.prev_log_term:
-                    # If an existing entry conflicts with a new one (same index but different terms),
-                    # delete the existing entry and all that follow it (§5.3)
-                    pruned_logs = existing_logs[:msg.prev_log_idx]
-                    self._node_persistent_state.set_logs(pruned_logs)
-                    LOG.debug('handle_append_entries: node_id:%d did not find existing entry with idx:%d',
-                              self._node_id, msg.prev_log_idx)
-                    return current_term, False
+            return current_term, True, 0, 0
 
-            last_commit_idx = self._node_persistent_state.append_log(msg.entry)
-            if msg.leader_commit_idx > self._node_volatile_state.get_commit_idx():
-                self._node_volatile_state.set_commit_idx(min(msg.leader_commit_idx, last_commit_idx))
-            else:
-                self._node_volatile_state.set_commit_idx(last_commit_idx)
+    def handle_install_snapshot(self, bytes_: bytes) -> Tuple[int, bool]:
+        LOG.debug("Node handle_install_snapshot bytes:%d", len(bytes_))
+        with self._lock:
+            msg: InstallSnapshotMessage = InstallSnapshotMessage.from_bytes(bytes_)
+            LOG.debug("node_id:%s InstallSnapshotMessage term:%d leader_id:%d last_included_idx:%d "
+                      "last_included_term:%d", self._node_id, msg.term, msg.leader_id, msg.last_included_idx,
+                      msg.last_included_term)
+            current_term: int = self._node_persistent_state.get_term()
+            # Reply immediately if term < currentTerm
+            if msg.term < current_term:
+                return current_term, False
+
+            if self._state != Node.STATE_FOLLOWER:
+                LOG.warning("node_id:%s got InstallSnapshot, becoming follower", self._node_id)
+                self.set_state(Node.STATE_FOLLOWER)
+            self.reset_election_timeout()
+            if msg.term > current_term:
+                LOG.info("node_id:%s current_term:%d -> %d", self._node_id, current_term, msg.term)
+                current_term = msg.term
+                self._node_persistent_state.set_term(current_term)
             self._leader_id = int(msg.leader_id)
+            self._leader_contact = time.monotonic()
+            self._leader_commit_idx = max(self._leader_commit_idx, msg.last_included_idx)
+
+            # nothing to do if we have already applied everything the snapshot covers
+            if msg.last_included_idx <= self._node_volatile_state.get_last_applied():
+                return current_term, True
 
+            # Reset state machine using snapshot contents
+            rows = json.loads(msg.data.decode('utf-8'))
+            with self._db_lock:
+                if not operation.restore(self._dbconn, "room", rows, last_applied=msg.last_included_idx):
+                    return current_term, False
+                # Save snapshot file, retain any existing log entries following it, discard the rest
+                self._node_persistent_state.save_snapshot(msg.last_included_idx, msg.last_included_term, msg.data)
+                self._node_volatile_state.set_last_applied(msg.last_included_idx)
+            if msg.last_included_idx > self._node_volatile_state.get_commit_idx():
+                self.advance_commit_idx(msg.last_included_idx)
+            LOG.info("node_id:%s installed snapshot last_included_idx:%d", self._node_id, msg.last_included_idx)
             return current_term, True
 
     def handle_request_vote(self, bytes_: bytes):
@@ -292,83 +686,410 @@ class Node(object):
                 LOG.debug("Node handle_request_vote: msg_term:%d behind current_term:%d ", current_term, msg.term)
                 return current_term, False
 
+            # A server that has heard from a current leader within the minimum election timeout neither updates its
+            # term nor grants its vote: the leader is alive, and may be serving reads under its lease
+            if self.heard_from_leader():
+                LOG.debug("Node handle_request_vote: heard from leader node_id:%s recently, ignoring node_id:%d",
+                          self._leader_id, msg.candidate_id)
+                return current_term, False
+
+            # If RPC request or response contains term T > currentTerm:
+            # set currentTerm = T, convert to follower (§5.1)
+            # The new term is persisted together with the vote decision below.
+            if msg.term > current_term:
+                LOG.info("node_id:%s current_term:%d -> %d", self._node_id, current_term, msg.term)
+                current_term = msg.term
+                self.set_state(Node.STATE_FOLLOWER)
+                voted_for = None
+            else:
+                voted_for = self._node_persistent_state.get_voted_for()
+
             # If votedFor is null or candidateId, and candidate’s log is at
             # least as up-to-date as receiver’s log, grant vote (§5.2, §5.4)
-            voted_for = self._node_persistent_state.get_voted_for()
             if voted_for is not None and voted_for != msg.candidate_id:
                 LOG.debug("Node handle_request_vote: already voted for node_id:%d", voted_for)
                 return current_term, False
 
-            our_last_log_idx, _ = self._node_persistent_state.get_last_log()
-
-            if our_last_log_idx > msg.last_log_idx:
-                LOG.debug(
-                    "Node handle_request_vote: candidate not up to date: our_last_log_idx:%d log_idx:%s node_id:%s",
-                    our_last_log_idx, msg.last_log_idx, msg.candidate_id)
+            if not self.is_up_to_date(msg.last_log_idx, msg.last_log_term):
+                LOG.debug("Node handle_request_vote: candidate node_id:%s not up to date: last_log_idx:%d "
+                          "last_log_term:%d", msg.candidate_id, msg.last_log_idx, msg.last_log_term)
+                if current_term != self._node_persistent_state.get_term():
+                    self._node_persistent_state.set_term(current_term)
                 return current_term, False
 
             LOG.info("Node handle_request_vote: giving a vote to node_id:%d", msg.candidate_id)
-            self._node_persistent_state.set_voted_for(msg.candidate_id)
+            self._node_persistent_state.set_term(current_term, msg.candidate_id)
+            self.reset_election_timeout()
+            return current_term, True
+
+    def handle_pre_vote(self, bytes_: bytes):
+        """
+        Tells a would-be candidate whether we would vote for it in the term it would start an election in, as
+        handle_request_vote would, but without updating our term or vote, or restarting our election timeout.
+        """
+        LOG.debug("Node handle_pre_vote bytes:%s", bytes_)
+        with self._lock:
+            msg: PreVoteMessage = PreVoteMessage.from_bytes(bytes_)
+            current_term: int = self._node_persistent_state.get_term()
+            if msg.term < current_term:
+                LOG.debug("Node handle_pre_vote: msg_term:%d behind current_term:%d", msg.term, current_term)
+                return current_term, False
+            voted_for = self._node_persistent_state.get_voted_for()
+            if msg.term == current_term and voted_for is not None and voted_for != msg.candidate_id:
+                LOG.debug("Node handle_pre_vote: already voted for node_id:%d", voted_for)
+                return current_term, False
+            # there is no election to win while the leader is alive
+            if self._state == Node.STATE_LEADER or self.heard_from_leader():
+                LOG.debug("Node handle_pre_vote: leader node_id:%s is alive, not for node_id:%d", self._leader_id,
+                          msg.candidate_id)
+                return current_term, False
+            if not self.is_up_to_date(msg.last_log_idx, msg.last_log_term):
+                LOG.debug("Node handle_pre_vote: candidate node_id:%s not up to date: last_log_idx:%d "
+                          "last_log_term:%d", msg.candidate_id, msg.last_log_idx, msg.last_log_term)
+                return current_term, False
+            LOG.debug("Node handle_pre_vote: would vote for node_id:%d in term:%d", msg.candidate_id, msg.term)
             return current_term, True
 
-    def handle_database_request(self, bytes_: bytes):
+    def heard_from_leader(self) -> bool:
+        """
+        Whether, not leading ourselves, we heard from a leader within the minimum election timeout, which no election
+        can have replaced yet. Whatever our role, so that a vote or pre-vote is never granted under the leader's lease.
+        Having started within the minimum election timeout counts, as we may have heard from one before restarting.
+        Must be called with self._lock held.
+        """
+        if self._state == Node.STATE_LEADER:
+            return False
+        now = time.monotonic()
+        return any(t is not None and (now - t) * 1000 < self._election_timeout_ms_min
+                   for t in [self._leader_contact, self._started_at])
+
+    def is_up_to_date(self, last_log_idx: int, last_log_term: int) -> bool:
+        """
+        Whether a log ending with an entry at last_log_idx of last_log_term is at least as up-to-date as ours: if the
+        logs have last entries with different terms, then the log with the later term is more up-to-date. If the logs
+        end with the same term, then whichever log is longer is more up-to-date (§5.4.1).
+        Must be called with self._lock held.
+        """
+        our_last_log_idx, _ = self._node_persistent_state.get_last_log()
+        our_last_log_term = self._node_persistent_state.get_log_term(our_last_log_idx)
+        return (last_log_term, last_log_idx) >= (our_last_log_term, our_last_log_idx)
+
+    def handle_database_request(self, bytes_: bytes) -> Tuple[int, bool, int]:
+        """
+        Books a room through the log, and waits for the booking to be applied.
+        :return: (log_idx, success, booked): booked is 1 if the room has just been booked, 0 if it already was, and
+                 -1 if it could not be booked. log_idx is -2 if we are not the leader.
+        """
         LOG.debug("Node handle_database_request bytes:%s", bytes_)
         if not self.is_leader():
             # TODO: return the leader ID
             LOG.warning("handle_database_request: not leader")
-            LOG.warning("leader is %d", self._leader_id)
+            LOG.warning("leader is %s", self._leader_id)
             msg: DbEntriesMessage = DbEntriesMessage.from_bytes(bytes_)
             for p in self._peers:
                 if p._peer_id == self._leader_id:
-                    threading.Thread(target=self._client.send, args=(p, msg)).start()
-
-            return -2, False
-
+                    self._rpc_pool.submit(self._client.send, p, msg)
+
+            return -2, False, 0
+
+        # sanity check: we want it to be a valid message before we commit it
+        msg: DbEntriesMessage = DbEntriesMessage.from_bytes(bytes_)
+        proposal = self.propose(bytes(msg))
+        try:
+            # give up after as long as a peer may take to answer a single request. The entry stays in our log
+            # (§5.3), and may still be committed later
+            result = proposal.result(timeout=self._election_timeout_ms_max / 1000)
+        except concurrent.futures.TimeoutError:
+            LOG.error("handle_database_request: request %s not applied in time", msg)
+            return 0, False, 0
+        except RuntimeError as e:
+            LOG.warning("handle_database_request: request %s failed: %s", msg, e)
+            return -2 if proposal.log_idx is None else 0, False, 0
+        # -1 if the room could not be booked at all
+        return proposal.log_idx, True, -1 if result is None else result
+
+    def propose(self, data: bytes) -> Proposal:
+        """
+        Proposes data as a new entry of our log, without waiting for it to be appended; see propose_forever.
+        :return: the proposal, resolved once its entry is applied
+        """
+        proposal = Proposal(data)
+        with self._lock:
+            if self._state != Node.STATE_LEADER:
+                proposal.set_exception(RuntimeError('node_id:%d is not the leader' % self._node_id))
+                return proposal
+            self._proposals.append(proposal)
+            if len(self._proposals) == 1:
+                self._proposals_since = time.monotonic()
+                self._proposal_cond.notify_all()
+            elif len(self._proposals) == self._max_append_entries:
+                self._proposal_cond.notify_all()
+        return proposal
+
+    def propose_forever(self):
+        """
+        Appends proposals to our log in batches: those that arrive within proposal_batch_ms of the first one of a
+        batch, or until max_append_entries of them are waiting, with a single write, so that a burst of proposals
+        costs a single write and a single round of replication. Proposals arriving while a batch is flushed to our
+        disk make up the next one.
+        """
+        LOG.debug("Node proposing forever")
+        while True:
+            with self._lock:
+                while not self._proposals and not self._stopped:
+                    self._proposal_cond.wait()
+                if self._stopped:
+                    # as we no longer lead, fails whatever was proposed meanwhile
+                    self.append_proposals()
+                    return
+                deadline = self._proposals_since + self._proposal_batch_ms / 1000
+                while len(self._proposals) < self._max_append_entries:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._proposal_cond.wait(remaining)
+                last_idx = self.append_proposals()
+            if last_idx is None:
+                continue
+            # the entries only count as replicated on the leader once they are on our disk too
+            self._node_persistent_state.wait_durable(last_idx)
+            with self._lock:
+                if self._state == Node.STATE_LEADER:
+                    self.maybe_advance_commit_idx()
+
+    def append_proposals(self) -> Optional[int]:
+        """
+        Appends the waiting proposals to our log with a single write, noting where each one is.
+        Must be called with self._lock held.
+        :return: the index of the last entry appended, or None if there were none, or we are not the leader
+        """
+        batch, self._proposals = self._proposals, []
+        if not batch:
+            return None
+        if self._state != Node.STATE_LEADER:
+            LOG.warning("append_proposals: no longer leader, dropping %d proposals", len(batch))
+            for proposal in batch:
+                proposal.set_exception(RuntimeError('node_id:%d is not the leader' % self._node_id))
+            return None
+        current_term = self._node_persistent_state.get_term()
+        # our own write is flushed while the entries are sent to the followers
+        last_idx = self._node_persistent_state.append_logs([Entry(current_term, p.data) for p in batch], sync=False)
+        for log_idx, proposal in enumerate(batch, last_idx - len(batch) + 1):
+            proposal.log_idx = log_idx
+            proposal.term = current_term
+            self._proposed[log_idx] = proposal
+        self._proposal_stats['proposals'] += len(batch)
+        self._proposal_stats['batches'] += 1
+        self.notify_replication()
+        return last_idx
+
+    def handle_read_index(self, bytes_: bytes) -> Tuple[int, bool, int]:
+        """
+        Waits until our database reflects every entry committed before now, so that a read from it is linearizable.
+        The leader works out the read index itself; a follower asks the leader for it, then waits to apply it.
+        If the client allows a stale read and our database is within its bounds, the read goes ahead straight away.
+        :return: (current_term, success, read_idx)
+        """
+        LOG.debug("Node handle_read_index bytes:%s", bytes_)
+        msg: ReadIndexMessage = ReadIndexMessage.from_bytes(bytes_)
         with self._lock:
-            # sanity check: we want it to be a valid message before we commit it
-            msg: DbEntriesMessage = DbEntriesMessage.from_bytes(bytes_)
             current_term = self._node_persistent_state.get_term()
-            new_entry = Entry(current_term, bytes(msg))
-            log_idx = self._node_persistent_state.append_log(new_entry)
-            peer_idx = log_idx - 1
-
-            append_msg = AppendEntriesMessage(
-                self._node_persistent_state.get_term(),
-                self._node_id,
-                peer_idx,
-                current_term,
-                self._node_volatile_state.get_commit_idx(),
-                new_entry,
-            )
-            acks_required: int = int(len(self._peers) / 2)
-            acks_received: int = 0
-            for peer in self._peers:
-                try:
-                    peer_term, ok = self._client.send(peer, append_msg)
-                    # TODO: check peer term to see if we need to step down
-                    if not ok:
-                        LOG.warning("handle_database_request: peer:%s (term:%d) failed to ack AppendEntries msg:%s",
-                                    peer,
-                                    peer_term, append_msg)
-                    else:
-                        acks_received += 1
-                        self._leader_volatile_state.set_match_idx(peer, log_idx)
-                except Exception as e:
-                    LOG.error("handle_database_request: peer:%s failed to ack AppendEntries msg:%s error:%s",
-                              peer, append_msg, e)
-
-            if acks_received < acks_required:
-                LOG.error("handle_database_request: insufficient acks for request %s: got %d, want %d", msg,
-                          acks_received, acks_required)
-                existing_logs: List[Entry] = self._node_persistent_state.get_logs()
-                pruned_logs = existing_logs[:peer_idx]
-                self._node_persistent_state.set_logs(pruned_logs)
-                return 0, False
-
-            operation.update(self._dbconn, "room", msg.room)
-            self._node_volatile_state.set_commit_idx(log_idx)
-
-            return log_idx, True
+            is_leader = self._state == Node.STATE_LEADER
+            leader = [p for p in self._peers if p._peer_id == self._leader_id]
+            if msg.allows_stale():
+                lag_entries, staleness_ms = self.staleness()
+                if (msg.max_lag_entries is None or lag_entries <= msg.max_lag_entries) and \
+                        (msg.max_staleness_ms is None or staleness_ms <= msg.max_staleness_ms):
+                    self._read_stats['local'] += 1
+                    return current_term, True, self._node_volatile_state.get_last_applied()
+                LOG.debug("handle_read_index: lag_entries:%s staleness_ms:%s out of bounds, reading through the "
+                          "leader", lag_entries, staleness_ms)
+        if is_leader:
+            read_idx = self.read_index()
+            if read_idx is None:
+                return current_term, False, 0
+            with self._lock:
+                self._read_stats['read_index'] += 1
+            return current_term, True, read_idx
+        if msg.forwarded or not leader:
+            return current_term, False, 0
+
+        try:
+            _, ok, read_idx = self._client.send_read_index(leader[0], ReadIndexMessage(forwarded=True))
+        except Exception as e:
+            LOG.warning("handle_read_index: leader:%s exception:%s", leader[0], e)
+            return current_term, False, 0
+        if not ok:
+            return current_term, False, 0
+        deadline = time.time() + self._election_timeout_ms_max / 1000
+        with self._lock:
+            if not self.wait_applied(read_idx, deadline):
+                return current_term, False, 0
+            self._read_stats['read_index'] += 1
+        return current_term, True, read_idx
+
+    def read_index(self) -> Optional[int]:
+        """
+        ReadIndex: records the commit index, confirms that we are still the leader with a round of heartbeats, and
+        waits until the commit index is applied. Reads waiting at the same time share a round of heartbeats.
+        :return: the index reads may now be served at, or None if we are not the leader or could not confirm it in
+                 time
+        """
+        deadline = time.time() + self._election_timeout_ms_max / 1000
+        with self._lock:
+            leader_state = self._leader_volatile_state
+            # until an entry of our term is committed, we do not know which entries before it are (§8)
+            while self._node_persistent_state.get_log_term(self._node_volatile_state.get_commit_idx()) != \
+                    self._node_persistent_state.get_term():
+                if not self.wait_leading(leader_state, self._replication_cond, deadline):
+                    return None
+            read_idx = self._node_volatile_state.get_commit_idx()
+            if self._lease_reads and self.lease_remaining_ms() > 0:
+                # no other leader can have been elected yet, so there is no need to check
+                if not self.wait_applied(read_idx, deadline):
+                    return None
+                return read_idx
+            # the round must start after the commit index was read
+            read_seq = self._read_seq + 1
+            if self._read_wanted < read_seq:
+                self._read_wanted = read_seq
+                for peer in self._peers:
+                    self.send_heartbeat(peer)
+            while not self.read_confirmed(read_seq):
+                if not self.wait_leading(leader_state, self._replication_cond, deadline):
+                    LOG.warning("read_index: could not confirm leadership for read at idx:%d", read_idx)
+                    return None
+            if not self.wait_applied(read_idx, deadline):
+                return None
+            return read_idx
+
+    def read_confirmed(self, read_seq: int) -> bool:
+        """
+        Whether a majority of the cluster, ourselves included, has answered a heartbeat from round read_seq or later.
+        Must be called with self._lock held, while we lead.
+        """
+        acks = 1 + sum(1 for peer in self._peers if self._leader_volatile_state.get_read_acked(peer) >= read_seq)
+        return acks > (len(self._peers) + 1) / 2
+
+    def lease_remaining_ms(self) -> float:
+        """
+        How long we hold the lease for: a majority of the cluster, ourselves included, has acked AppendEntries sent
+        at or after some time, and none of them grants a vote to another candidate until election_timeout_ms_min
+        later (see handle_request_vote), less lease_margin_ms. Must be called with self._lock held.
+        :return: milliseconds left, 0 or less if we do not hold it
+        """
+        if self._state != Node.STATE_LEADER:
+            return 0
+        return (self.majority_acked_at() - time.monotonic()) * 1000 + self._election_timeout_ms_min - \
+            self._lease_margin_ms
+
+    def majority_acked_at(self) -> float:
+        """
+        The time, on the monotonic clock, by which a majority of the cluster, ourselves included, had acked
+        AppendEntries from us. Must be called with self._lock held, while we lead.
+        """
+        acked_at = sorted([time.monotonic()] + [self._leader_volatile_state.get_acked_at(peer)
+                                                for peer in self._peers], reverse=True)
+        return acked_at[len(acked_at) // 2]
+
+    def staleness(self) -> Tuple[float, float]:
+        """
+        How far our database may be behind the cluster's: the committed entries we know of but have not applied,
+        and the milliseconds since we last heard from the leader or, if we lead, since a majority last acked us.
+        Must be called with self._lock held.
+        :return: (lag_entries, staleness_ms), both infinite if we have never heard from a leader
+        """
+        last_applied = self._node_volatile_state.get_last_applied()
+        if self._state == Node.STATE_LEADER:
+            lag_entries = self._node_volatile_state.get_commit_idx() - last_applied
+            return max(0, lag_entries), (time.monotonic() - self.majority_acked_at()) * 1000
+        if self._leader_contact is None:
+            return math.inf, math.inf
+        return max(0, self._leader_commit_idx - last_applied), (time.monotonic() - self._leader_contact) * 1000
+
+    def wait_leading(self, leader_state: LeaderVolatileState, cond: threading.Condition, deadline: float) -> bool:
+        """
+        Waits on cond, which must use self._lock, which must be held, until woken or deadline.
+        :return: False if the deadline has passed, or we no longer lead as we did with leader_state
+        """
+        remaining = deadline - time.time()
+        if remaining <= 0 or self._state != Node.STATE_LEADER or self._leader_volatile_state is not leader_state:
+            return False
+        cond.wait(remaining)
+        return self._state == Node.STATE_LEADER and self._leader_volatile_state is leader_state
+
+    def wait_applied(self, idx: int, deadline: float) -> bool:
+        """
+        Waits until the entry at idx is applied, or deadline. Must be called with self._lock held.
+        :return: whether it was applied
+        """
+        while self._node_volatile_state.get_last_applied() < idx:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                LOG.warning("wait_applied: idx:%d not applied in time", idx)
+                return False
+            self._applied_cond.wait(remaining)
+        return True
+
+    def maybe_advance_commit_idx(self):
+        """
+        If there exists an N such that N > commitIndex, a majority of matchIndex[i] ≥ N, and log[N].term ==
+        currentTerm: set commitIndex = N (§5.3, §5.4). Our own matchIndex is our last entry on disk.
+        Must be called with self._lock held, while we lead.
+        """
+        match_idxs = sorted([self._node_persistent_state.get_durable_idx()] +
+                            [self._leader_volatile_state.get_match_idx(peer) for peer in self._peers], reverse=True)
+        # the highest index that a majority of the cluster has
+        majority_idx = match_idxs[len(match_idxs) // 2]
+        if majority_idx <= self._node_volatile_state.get_commit_idx():
+            return
+        # entries from previous terms are only committed by committing one from ours after them (§5.4.2)
+        if self._node_persistent_state.get_log_term(majority_idx) != self._node_persistent_state.get_term():
+            return
+        self.advance_commit_idx(majority_idx)
+
+    def advance_commit_idx(self, idx: int):
+        """
+        Moves the commit index up to idx, if it is behind, and wakes the applier. Must be called with self._lock held.
+        """
+        if idx > self._node_volatile_state.get_commit_idx():
+            self._node_volatile_state.set_commit_idx(idx)
+            self._commit_cond.notify_all()
+            if self._state == Node.STATE_LEADER:
+                # pass the new commit index on to the followers
+                self.notify_replication()
+
+    def set_state(self, state: int):
+        """
+        Changes our role to state, waking everything waiting on what we do next. Must be called with self._lock held.
+        """
+        if self._state == Node.STATE_LEADER and state != Node.STATE_LEADER:
+            # the election timer stopped while we led
+            self.reset_election_timeout()
+        self._state = state
+        self._replication_cond.notify_all()
+        if state != Node.STATE_LEADER and self._proposed:
+            # whether our entries are committed is now up to the next leader
+            for proposal in self._proposed.values():
+                proposal.set_exception(RuntimeError('node_id:%d stopped leading before applying entry %d' % (
+                    self._node_id, proposal.log_idx)))
+            self._proposed = {}
+
+    def maybe_step_down(self, their_term: int) -> bool:
+        """
+        If RPC request or response contains term T > currentTerm: set currentTerm = T, convert to follower (§5.1).
+        Must be called with self._lock held.
+        :return: True if their_term was newer than ours
+        """
+        current_term = self._node_persistent_state.get_term()
+        if their_term <= current_term:
+            return False
+        LOG.info("node_id:%d term:%d is behind a peer's term:%d, becoming follower", self._node_id, current_term,
+                 their_term)
+        self._node_persistent_state.set_term(their_term)
+        self.set_state(Node.STATE_FOLLOWER)
+        self.reset_election_timeout()
+        return True
 
     def handle_state_request(self) -> bytes:
         if self._state == Node.STATE_LEADER:
@@ -384,6 +1105,23 @@ class Node(object):
             else:
                 peer_state = "FOLLOWER_OR_CANDIDATE"
             parts.append("%s %d:%s:%d" % (peer_state, peer._peer_id, peer._host, peer._port))
+        log_stats = self._node_persistent_state.get_log_stats()
+        parts.append("STATS log_batches:%d log_records:%d log_fsyncs:%d" % (
+            log_stats['batches'], log_stats['records'], log_stats['fsyncs']))
+        with self._lock:
+            lease_remaining_ms = self.lease_remaining_ms() if self._lease_reads else 0
+            read_stats = dict(self._read_stats)
+            proposal_stats = dict(self._proposal_stats)
+            election_stats = dict(self._election_stats)
+        parts.append("LEASE enabled:%d valid:%d remaining_ms:%d" % (
+            self._lease_reads, lease_remaining_ms > 0, max(0, lease_remaining_ms)))
+        parts.append("PROPOSALS proposals:%d batches:%d" % (proposal_stats['proposals'], proposal_stats['batches']))
+        parts.append("READS local:%d read_index:%d" % (read_stats['local'], read_stats['read_index']))
+        parts.append("ELECTIONS pre_votes:%d elections:%d" % (election_stats['pre_votes'], election_stats['elections']))
+        apply_stats = dict(self._apply_stats)
+        parts.append("APPLY last_applied:%d entries:%d batches:%d entries_per_sec:%.1f" % (
+            self._node_volatile_state.get_last_applied(), apply_stats['entries'], apply_stats['batches'],
+            apply_stats['entries'] / apply_stats['seconds'] if apply_stats['seconds'] > 0 else 0.0))
         parts.append("\n")
         return bytes("\n".join(parts), encoding="utf-8")
 
@@ -391,49 +1129,115 @@ class Node(object):
         with self._lock:
             return self._state == Node.STATE_LEADER
 
-    def become_leader(self) -> bool:
+    def become_leader(self, term: int) -> bool:
+        """
+        Takes over as leader for term, if we are still a candidate in it.
+        """
         LOG.debug("node_id:%d becoming leader", self._node_id)
         with self._lock:
-            if self._state == Node.STATE_LEADER:
+            if self._state != Node.STATE_CANDIDATE or self._node_persistent_state.get_term() != term:
                 return False
 
-            self._state = Node.STATE_LEADER
+            self.set_state(Node.STATE_LEADER)
             self._votes = 0
             # reinitialize leader volatile state after an election
             last_log_idx, _ = self._node_persistent_state.get_last_log()
             self._leader_volatile_state = LeaderVolatileState(last_log_idx, self._peers)
             LOG.debug("init leader volatile state: %s", self._leader_volatile_state)
+            # commit an entry of our own term straight away (§8)
+            self._node_persistent_state.append_log(Entry(term, bytes(NoopMessage())), sync=False)
+            self.notify_replication()
 
             for peer in self._peers:
-                threading.Thread(target=self.heartbeat, args=(peer,)).start()
-                threading.Thread(target=self.sync_peer, args=(peer,)).start()
+                self._scheduler.call_soon(functools.partial(self.heartbeat, self._leader_volatile_state, peer))
 
     def is_candidate(self) -> bool:
         with self._lock:
             return self._state == Node.STATE_CANDIDATE
 
+    def start_pre_vote(self):
+        """
+        Asks the peers whether they would vote for us in our next term, and becomes a candidate in it once a majority
+        would: a node that could not win an election, e.g. one cut off from the rest of the cluster, then does not
+        raise its term with each attempt, to depose the leader with it once it can reach the others again (§9.6 of the
+        Raft dissertation). Without pre-votes, becomes a candidate straight away.
+        """
+        with self._lock:
+            if self._stopped or self._state == Node.STATE_LEADER or time.monotonic() < self._election_deadline:
+                # we heard from a leader, granted a vote or won an election since the election timeout elapsed
+                return
+            elect = not self._pre_vote or not self._peers
+            if not elect:
+                LOG.debug("node_id:%d asking for pre-votes", self._node_id)
+                self._election_stats['pre_votes'] += 1
+                # answers from any earlier round no longer count
+                self._pre_vote_round += 1
+                self._pre_votes = 1
+                # ask again if no majority would vote for us by the time the election timeout elapses again
+                self.reset_election_timeout()
+                term = self._node_persistent_state.get_term() + 1
+                last_log_idx, _ = self._node_persistent_state.get_last_log()
+                last_log_term = self._node_persistent_state.get_log_term(last_log_idx)
+                for peer in self._peers:
+                    self._rpc_pool.submit(self.request_pre_vote, peer, self._pre_vote_round, term, last_log_idx,
+                                          last_log_term)
+        if elect:
+            self.become_candidate()
+
+    def request_pre_vote(self, peer: Peer, pre_vote_round: int, term: int, last_log_idx: int, last_log_term: int):
+        """
+        Asks peer whether it would vote for us in term, from the RPC pool. Peers that do not answer are asked again
+        in the next round only.
+        """
+        msg = PreVoteMessage(term, self._node_id, last_log_idx, last_log_term)
+        try:
+            their_term, granted = self._client.send(peer, msg)
+        except Exception as e:
+            LOG.warning("request_pre_vote: exception requesting pre-vote from peer:%s: %s", peer, e)
+            return
+
+        with self._lock:
+            if self.maybe_step_down(their_term):
+                return
+            if not granted:
+                LOG.debug("request_pre_vote: peer:%s would not vote for us in term:%d", peer, term)
+                return
+            # the pre-vote only counts towards this round, while nothing has happened since that makes it moot
+            if self._pre_vote_round != pre_vote_round or self._node_persistent_state.get_term() != term - 1 or \
+                    self._state == Node.STATE_LEADER or self.heard_from_leader():
+                return
+            self._pre_votes += 1
+            # pre-votes include our own, so this is a majority of the whole cluster
+            elect = self._pre_votes > (len(self._peers) + 1) / 2
+            if elect:
+                self._pre_vote_round += 1
+        if elect:
+            LOG.debug("node_id:%s won pre-vote for term:%d", self._node_id, term)
+            self.become_candidate()
+
     def become_candidate(self) -> bool:
         LOG.debug("node_id:%d becoming candidate", self._node_id)
         # On conversion to candidate, start election:
         with self._lock:
-            self._state = Node.STATE_CANDIDATE
-            # increment currentTerm
-            current_term = self._node_persistent_state.increment_term()
-            # vote for self
-            self._node_persistent_state.set_voted_for(self._node_id)
+            if self._stopped:
+                return False
+            self._election_stats['elections'] += 1
+            self.set_state(Node.STATE_CANDIDATE)
+            # increment currentTerm and vote for self, in one write
+            current_term = self._node_persistent_state.increment_term(voted_for=self._node_id)
+            self._votes = 1
             # reset election timer
-            self._election_timeout_ms = random.randint(self._election_timeout_ms_min, self._election_timeout_ms_max)
+            self.reset_election_timeout()
             # send RequestVote RPC to all other servers
-            logs = self._node_persistent_state.get_logs()
-            last_log_idx = max(len(logs) - 1, 0)
-            try:
-                last_log_term = logs[-1]._term
-            except IndexError:
-                last_log_term = 0
+            last_log_idx, _ = self._node_persistent_state.get_last_log()
+            last_log_term = self._node_persistent_state.get_log_term(last_log_idx)
 
             for peer in self._peers:
-                threading.Thread(target=self.request_vote,
-                                 args=(peer, current_term, last_log_idx, last_log_term)).start()
+                self._rpc_pool.submit(self.request_vote, peer, current_term, last_log_idx, last_log_term)
+            # with no peers, our own vote is a majority
+            won = self._votes > (len(self._peers) + 1) / 2
+        if won:
+            self.become_leader(current_term)
         return True
 
     def is_follower(self) -> bool:
@@ -443,77 +1247,121 @@ class Node(object):
     def become_follower(self) -> bool:
         LOG.debug("node_id:%d becoming follower", self._node_id)
         with self._lock:
-            self._state = Node.STATE_FOLLOWER
+            self.set_state(Node.STATE_FOLLOWER)
             return True
 
     def request_vote(self, peer: Peer, curr_term: int, last_log_idx: int, last_log_term: int):
+        """
+        Asks peer for its vote in curr_term, from the RPC pool. If peer does not answer, asks again loop_interval_ms
+        after asking, until the election is over.
+        """
+        with self._lock:
+            if self._state != Node.STATE_CANDIDATE or self._node_persistent_state.get_term() != curr_term:
+                LOG.info("request_vote: node_id:%d no longer polling for votes in term:%d", self._node_id, curr_term)
+                return
         msg = VoteMessage(curr_term, self._node_id, last_log_idx, last_log_term)
-        while True:
-            with self._lock:
-                if self._state != Node.STATE_CANDIDATE or self._node_persistent_state.get_term() != curr_term:
-                    LOG.info("request_vote: node_id:%d no longer polling for votes in term:%d", self._node_id,
-                             curr_term)
-                    return
-            start = time.time()
-            try:
-                their_term, got_vote = self._client.send(peer, msg)
-                if got_vote is None:
-                    # We did not get receive a vote for one of two reasons:
-                    # 1) Our logs are out of date, or
-                    # 2) Our term is older.
-                    # In either case, update our term and become a follower
-                    # But first, a sanity check:
-                    with self._lock:
-                        self._node_persistent_state.set_term(their_term)
-                        self._state = Node.STATE_FOLLOWER
-                        return
-
-                # cool, we got a vote!
-                # make sure we're still a candidate
-                with self._lock:
-                    if self._state == Node.STATE_CANDIDATE:
-                        self._votes += 1
-            except Exception as e:
-                LOG.error("request_vote: exception requesting vote from peer:%s: %s", peer, e)
-            finally:
-                if self._votes > len(self._peers) / 2:
-                    LOG.debug("node_id:%s won election term:%d", self._node_id, curr_term)
-                    self.become_leader()
-
-                elapsed_ms = int(time.time() - start)
-                time.sleep((self._loop_interval_ms - elapsed_ms) / 1000)
+        start = time.time()
+        try:
+            their_term, got_vote = self._client.send(peer, msg)
+        except Exception as e:
+            LOG.error("request_vote: exception requesting vote from peer:%s: %s", peer, e)
+            elapsed_ms = int((time.time() - start) * 1000)
+            self._scheduler.call_later(max(0, self._loop_interval_ms - elapsed_ms) / 1000, functools.partial(
+                self._rpc_pool.submit, self.request_vote, peer, curr_term, last_log_idx, last_log_term))
+            return
 
-    def heartbeat(self, peer):
-        while True:
-            if self._state != Node.STATE_LEADER:
+        with self._lock:
+            if self.maybe_step_down(their_term):
                 return
-
-            start = time.time()
-            with self._lock:
-                current_term = self._node_persistent_state.get_term()
-                commit_idx = self._node_volatile_state.get_commit_idx()
-                peer_next_idx: int = self._leader_volatile_state.get_next_idx(peer)
-                LOG.debug("heartbeat:%s current_term:%d commit_idx:%d peer_next_idx:%d", peer, current_term, commit_idx,
-                          peer_next_idx)
-
-            msg: AppendEntriesMessage = AppendEntriesMessage(
-                current_term,
-                self._node_id,
-                peer_next_idx,
-                current_term,
-                commit_idx,
-                None,
-            )
-            try:
-                their_term, ok = self._client.send(peer, msg)
-                # If their term is suddenly higher than ours, we may need to relinquish our throne
-                if their_term > current_term:
-                    LOG.info("peer:%s term (%d) is greater than ours (%d), stepping down as leader",
-                             peer, their_term, current_term)
-                    self._state = Node.STATE_FOLLOWER
-                    self.reset_election_timeout()
-            except Exception as e:
-                LOG.warning("peer:%s heartbeat exception:%s", peer, e)
-            finally:
-                elapsed_ms = int(time.time() - start)
-                time.sleep((self._loop_interval_ms - elapsed_ms) / 1000)
+            if not got_vote:
+                LOG.debug("request_vote: peer:%s did not vote for us in term:%d", peer, curr_term)
+                return
+            # cool, we got a vote! make sure it still counts
+            if self._state != Node.STATE_CANDIDATE or self._node_persistent_state.get_term() != curr_term:
+                return
+            self._votes += 1
+            # votes include our own, so this is a majority of the whole cluster
+            won = self._votes > (len(self._peers) + 1) / 2
+        if won:
+            LOG.debug("node_id:%s won election term:%d", self._node_id, curr_term)
+            self.become_leader(curr_term)
+
+    def heartbeat(self, leader_state: LeaderVolatileState, peer):
+        """
+        Runs on the scheduler every loop_interval_ms for each peer while we lead as we did with leader_state, and
+        sends peer a heartbeat.
+        """
+        with self._lock:
+            if self._state != Node.STATE_LEADER or self._leader_volatile_state is not leader_state:
+                return
+            self.send_heartbeat(peer)
+        self._scheduler.call_later(self._loop_interval_ms / 1000, functools.partial(self.heartbeat, leader_state, peer))
+
+    def send_heartbeat(self, peer):
+        """
+        Sends peer a heartbeat from the RPC pool, unless one is in flight already: then, if a read waits for a round
+        started since, another one follows as soon as it is answered. Must be called with self._lock held, while we
+        lead.
+        """
+        leader_state = self._leader_volatile_state
+        if leader_state.get_heartbeat_in_flight(peer) is not None:
+            return
+        # this heartbeat starts the round of confirmations wanted by reads waiting, if it is the first
+        self._read_seq = max(self._read_seq, self._read_wanted)
+        leader_state.set_heartbeat_in_flight(peer, self._read_seq)
+        current_term = self._node_persistent_state.get_term()
+        commit_idx = self._node_volatile_state.get_commit_idx()
+        peer_next_idx: int = leader_state.get_next_idx(peer)
+        LOG.debug("heartbeat:%s current_term:%d commit_idx:%d peer_next_idx:%d", peer, current_term, commit_idx,
+                  peer_next_idx)
+        # the follower only moves its commit index up to entries it has checked against ours
+        snapshot_idx, _ = self._node_persistent_state.get_snapshot()
+        last_log_idx, _ = self._node_persistent_state.get_last_log()
+        prev_log_idx = max(snapshot_idx, min(peer_next_idx - 1, last_log_idx))
+        prev_log_term = self._node_persistent_state.get_log_term(prev_log_idx)
+        leader_state.set_commit_sent(peer, max(leader_state.get_commit_sent(peer), commit_idx))
+        msg: AppendEntriesMessage = AppendEntriesMessage(
+            current_term,
+            self._node_id,
+            prev_log_idx,
+            prev_log_term,
+            commit_idx,
+        )
+        self._rpc_pool.submit(self.exchange_heartbeat, leader_state, peer, msg, self._read_seq)
+
+    def exchange_heartbeat(self, leader_state: LeaderVolatileState, peer, msg: AppendEntriesMessage, read_seq: int):
+        """
+        Sends peer a heartbeat built by send_heartbeat, and wakes replication when it answers.
+        """
+        if self._stopped:
+            # queued before we stopped
+            return
+        sent_at = time.monotonic()
+        try:
+            their_term, ok, conflict_term, conflict_idx = self._client.send_append_entries(peer, msg)
+        except Exception as e:
+            LOG.warning("peer:%s heartbeat exception:%s", peer, e)
+            their_term = None
+        with self._lock:
+            leader_state.set_heartbeat_in_flight(peer, None)
+            # If their term is suddenly higher than ours, we may need to relinquish our throne
+            if their_term is None or self.maybe_step_down(their_term):
+                return
+            if self._state != Node.STATE_LEADER or self._leader_volatile_state is not leader_state:
+                return
+            if their_term == msg.term:
+                # whether or not its log matches ours, peer still takes us for the leader
+                leader_state.set_read_acked(peer, max(leader_state.get_read_acked(peer), read_seq))
+                leader_state.set_acked_at(peer, max(leader_state.get_acked_at(peer), sent_at))
+                # our own last entries may have reached the disk after the peers acked them
+                self.maybe_advance_commit_idx()
+            if not ok and leader_state.get_next_idx(peer) > msg.prev_log_idx:
+                # the peer's log does not match ours at prev_log_idx: have replication go back to where it
+                # diverges (§5.3)
+                leader_state.set_next_idx(
+                    peer, self.next_idx_after_rejection(max(1, msg.prev_log_idx), conflict_term, conflict_idx))
+            # peer is reachable: retry whatever did not get there
+            self.notify_replication()
+            if self._read_wanted > read_seq:
+                # reads are waiting for a round that started after this heartbeat was sent
+                self.send_heartbeat(peer)
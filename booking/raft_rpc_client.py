@@ -10,18 +10,63 @@ LOG.setLevel(logging.DEBUG)
 
 
 class RpcClient(object):
+    def __init__(self, timeout: Optional[float] = None):
+        """
+        :param timeout: seconds to wait to connect to a peer, and then for each read or write, before giving up on
+            it. None waits forever.
+        """
+        self._timeout: Optional[float] = timeout
+
     def send(self, peer: Peer, msg) -> Tuple[Optional[int], Optional[bool]]:
+        term, success, _ = self.call(peer, msg)
+        return term, success
+
+    def send_append_entries(self, peer: Peer, msg) -> Tuple[int, bool, int, int]:
+        """
+        Sends an AppendEntriesMessage.
+        :return: (term, success, conflict_term, conflict_idx): on failure, the peer's hint of where its log diverges
+            from ours, see Node.handle_append_entries. Both are 0 if the peer gave none.
+        """
+        term, success, extra = self.call(peer, msg)
+        conflict_term, conflict_idx = (list(extra) + [0, 0])[:2]
+        return term, success, conflict_term, conflict_idx
+
+    def send_read_index(self, peer: Peer, msg) -> Tuple[int, bool, int]:
+        """
+        Sends a ReadIndexMessage.
+        :return: (term, success, read_idx): whether the read may go ahead, and the commit index it is served at
+        """
+        term, success, extra = self.call(peer, msg)
+        read_idx = extra[0] if extra else 0
+        return term, success, read_idx
+
+    def send_booking(self, peer: Peer, msg) -> Tuple[int, bool, int]:
+        """
+        Sends a DbEntriesMessage.
+        :return: (log_idx, success, booked): whether the booking was applied, and if so, 1 if it booked the room, 0 if
+            the room was already booked, -1 if it could not be booked. See Node.handle_database_request.
+        """
+        log_idx, success, extra = self.call(peer, msg)
+        booked = extra[0] if extra else 0
+        return log_idx, success, booked
+
+    def call(self, peer: Peer, msg) -> Tuple[int, bool, Tuple[int, ...]]:
+        """
+        Sends msg to peer and returns its reply: the peer's term, whether the request succeeded, and whatever further
+        fields the verb replies with.
+        """
         LOG.debug("RpcClient send peer %s msg:%s", peer, msg)
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self._timeout)
             try:
                 sock.connect(peer.hostport())
-                sock.sendall(bytes(msg))
-                resp = sock.recv(1024)
+                sock.sendall(bytes(msg) + b'\n')
+                resp = b''.join(iter(lambda: sock.recv(1024), b''))
                 LOG.debug("RpcClient response from peer %s: %s", peer, resp)
-                term_str, success_str = resp.strip().split(b' ')
+                term_str, success_str, *extra = resp.strip().split(b' ')
                 term = int(term_str)
                 success = success_str == b'1'
-                return term, success
+                return term, success, tuple(int(field) for field in extra)
             except Exception as e:
                 LOG.warning("Got RpcClient Exception: %s", e)
                 raise
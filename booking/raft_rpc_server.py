@@ -9,6 +9,8 @@ LOG.setLevel(logging.DEBUG)
 
 
 class RpcServer(object):
+    RECV_SIZE = 64 * 1024
+
     def __init__(self, host: str, port: int, handlers: Dict[bytes, Callable]):
         LOG.debug("RpcServer init host:%s port%d", host, port)
         self._host = host
@@ -22,7 +24,7 @@ class RpcServer(object):
             raise RuntimeError('RpcServer already running on %s:%d' % (self._host, self._port))
 
         factory = RpcServer._Dispatcher.factory(self._handlers)
-        self._server = socketserver.TCPServer((self._host, self._port), factory)
+        self._server = RpcServer._Server((self._host, self._port), factory)
         thread = threading.Thread(target=self._server.serve_forever)
         thread.daemon = True
         thread.start()
@@ -32,6 +34,8 @@ class RpcServer(object):
         if self._server is None:
             return
 
+        # serve_forever only returns once asked to, and would otherwise keep polling the closed socket
+        self._server.shutdown()
         self._server.server_close()
         self._server = None
 
@@ -41,6 +45,12 @@ class RpcServer(object):
 
         return self._server.server_address
 
+    class _Server(socketserver.ThreadingTCPServer):
+        # one thread per connection, so that a slow or stalled peer cannot hold up requests from everyone else
+        daemon_threads = True
+        # room for bursts of concurrent requests, e.g. reads, beyond the default backlog of 5 connections
+        request_queue_size = 128
+
     class _Dispatcher(socketserver.BaseRequestHandler):
         """
         Dispatcher is a BaseRequestHandler that knows how to dispatch stuff to its handlers.
@@ -52,17 +62,32 @@ class RpcServer(object):
             super().__init__(request, client_address, server)
 
         def handle(self):
-            data: bytes = self.request.recv(1024).strip()
+            data: bytes = self._recv_line().strip()
             # protocol looks like this:
-            # VERB arg1 arg2 arg3... argn
+            # VERB arg1 arg2 arg3... argn\n
             if data.startswith(b'state'):
                 resp = self._handlers[b'state']()
             else:
                 verb, rest = data.split(b' ', maxsplit=1)
-                current_term, success = self._handlers[verb](rest.strip())
-                resp = b'%d %d' % (current_term, success)
+                # current_term success [extra fields of the verb...]
+                resp = b' '.join(b'%d' % field for field in self._handlers[verb](rest.strip()))
             self.request.sendall(resp)
 
+        def _recv_line(self) -> bytes:
+            """
+            Reads one request, which ends with a newline or when the client closes its side of the connection.
+            Requests such as snapshots can be much larger than a single recv.
+            """
+            chunks = []
+            while True:
+                chunk = self.request.recv(RpcServer.RECV_SIZE)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                if chunk.endswith(b'\n'):
+                    break
+            return b''.join(chunks)
+
         @classmethod
         def factory(cls, handlers):
             """
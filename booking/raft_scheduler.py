@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+import heapq
+import itertools
+import logging
+import threading
+import time
+from typing import Callable, List, Tuple
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+
+
+class Timer(object):
+    """
+    A call scheduled with a Scheduler, which may be cancelled until it is made.
+    """
+
+    def __init__(self, when: float, fn: Callable[[], None]):
+        self.when: float = when
+        self.fn: Callable[[], None] = fn
+        self.cancelled: bool = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler(object):
+    """
+    Scheduler makes calls at given times on the monotonic clock, all from a single thread: the one running run().
+    Calls are made in order of their due times, and calls due at the same time in the order they were scheduled.
+    As a call holds up every call due after it, calls must not block: they hand anything slow to other threads.
+    Calls may be scheduled and cancelled from any thread, including from calls.
+    """
+
+    def __init__(self):
+        self._cond: threading.Condition = threading.Condition()
+        self._heap: List[Tuple[float, int, Timer]] = []
+        self._seq = itertools.count()  # breaks ties between calls due at the same time
+        self._stopped: bool = False
+
+    def __len__(self) -> int:
+        with self._cond:
+            return len(self._heap)
+
+    def call_at(self, when: float, fn: Callable[[], None]) -> Timer:
+        """
+        Schedules fn to be called at when, on the monotonic clock.
+        """
+        timer = Timer(when, fn)
+        with self._cond:
+            heapq.heappush(self._heap, (when, next(self._seq), timer))
+            if self._heap[0][2] is timer:
+                # due before whatever run() is waiting for
+                self._cond.notify()
+        return timer
+
+    def call_later(self, delay: float, fn: Callable[[], None]) -> Timer:
+        """
+        Schedules fn to be called in delay seconds.
+        """
+        return self.call_at(time.monotonic() + delay, fn)
+
+    def call_soon(self, fn: Callable[[], None]) -> Timer:
+        """
+        Schedules fn to be called as soon as possible, after the calls already due.
+        """
+        return self.call_at(time.monotonic(), fn)
+
+    def run(self):
+        """
+        Makes the calls as they fall due, until stop() is called.
+        """
+        LOG.debug("Scheduler running")
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopped:
+                        return
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    when, _, timer = self._heap[0]
+                    if timer.cancelled:
+                        heapq.heappop(self._heap)
+                        continue
+                    remaining = when - time.monotonic()
+                    if remaining <= 0:
+                        heapq.heappop(self._heap)
+                        break
+                    self._cond.wait(remaining)
+            try:
+                timer.fn()
+            except Exception as e:
+                LOG.exception("Scheduler: call %s failed: %s", timer.fn, e)
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
@@ -3,8 +3,10 @@ import datetime
 import json
 import logging
 import os
-from typing import Optional, List, Dict
+import threading
+from typing import Optional, List, Dict, Tuple, Iterator
 
+from raft_log import SegmentedLog, GroupCommitLog, LogSlice, LRUCache, HardStateFile, SnapshotFile, log_dirpath, hardstate_fpath, snapshot_fpath
 from raft_peer import Peer
 
 LOG = logging.getLogger(__name__)
@@ -16,11 +18,21 @@ class LeaderVolatileState(object):
     Volatile state on leaders: (Reinitialized after election)
         nextIndex[]: for each server, index of the next log entry to send to that server (initialized to leader last log index + 1)
         matchIndex[]: for each server, index of highest log entry known to be replicated on server (initialized to 0, increases monotonically)
+    With pipelined replication nextIndex runs ahead of the replies, and we also track how many messages to each server
+    are awaiting a reply, and the last commit index sent to it. For reads, we track the latest round of heartbeats
+    each server has answered, confirming that we still lead (§8), and when the latest AppendEntries it answered
+    was sent, on the monotonic clock, for leases. We keep one heartbeat at a time in flight to each server, and track
+    the round it belongs to, or None if there is none.
     """
 
     def __init__(self, last_log_index: int, known_peers: List[Peer]):
         self._next_idx: Dict[Peer, int] = {peer: last_log_index + 1 for peer in known_peers}
         self._match_idx: Dict[Peer, int] = {peer: 0 for peer in known_peers}
+        self._in_flight: Dict[Peer, int] = {peer: 0 for peer in known_peers}
+        self._commit_sent: Dict[Peer, int] = {peer: 0 for peer in known_peers}
+        self._read_acked: Dict[Peer, int] = {peer: 0 for peer in known_peers}
+        self._acked_at: Dict[Peer, float] = {peer: float('-inf') for peer in known_peers}
+        self._heartbeat_in_flight: Dict[Peer, Optional[int]] = {peer: None for peer in known_peers}
 
     def set_next_idx(self, k: Peer, v: int):
         self._next_idx[k] = v
@@ -34,6 +46,36 @@ class LeaderVolatileState(object):
     def get_match_idx(self, k: Peer) -> int:
         return self._match_idx[k]
 
+    def set_in_flight(self, k: Peer, v: int):
+        self._in_flight[k] = v
+
+    def get_in_flight(self, k: Peer) -> int:
+        return self._in_flight[k]
+
+    def set_commit_sent(self, k: Peer, v: int):
+        self._commit_sent[k] = v
+
+    def get_commit_sent(self, k: Peer) -> int:
+        return self._commit_sent[k]
+
+    def set_read_acked(self, k: Peer, v: int):
+        self._read_acked[k] = v
+
+    def get_read_acked(self, k: Peer) -> int:
+        return self._read_acked[k]
+
+    def set_acked_at(self, k: Peer, v: float):
+        self._acked_at[k] = v
+
+    def get_acked_at(self, k: Peer) -> float:
+        return self._acked_at[k]
+
+    def set_heartbeat_in_flight(self, k: Peer, v: Optional[int]):
+        self._heartbeat_in_flight[k] = v
+
+    def get_heartbeat_in_flight(self, k: Peer) -> Optional[int]:
+        return self._heartbeat_in_flight[k]
+
     def __str__(self):
         return "nextIndex:%s matchIndex:%s" % (self._next_idx, self._match_idx)
 
@@ -68,51 +110,83 @@ class NodePersistentState(object):
         currentTerm:  latest term server has seen (initialized to 0 on first boot, increases monotonically)
         votedFor:  candidateId that received vote in current term (or null if none)
         log[]:  log entries; each entry contains command for state machine, and term when entry was received by leader (first index is 1)
+    Log entries up to and including the last index of the latest snapshot are discarded (§7), so the entries held
+    start at get_first_log_idx().
+    Only the index of the log (offsets and terms) is kept in memory. Entries are read from disk when asked for,
+    through an LRU cache of at most cache_bytes.
     """
 
+    # rough per-entry overhead of an Entry object on top of its data, for sizing the cache
+    ENTRY_OVERHEAD_BYTES = 100
+
     @classmethod
-    def load(cls, fpath):
+    def load(cls, fpath, max_batch_size: int = 256, max_delay_ms: float = 0, cache_bytes: int = 4 * 1024 * 1024,
+             fsync: bool = True):
         """
         load persistent state from a file
-        :param fpath: path of state. Created if it does not already exist.
-        """
-        if not os.path.exists(fpath):
-            open(fpath, 'a').close()
-        with open(fpath, 'r') as f:
-            json_str = f.read()
-            json_obj = json.loads(json_str or '{}')
-            current_term = json_obj.get('current_term', 0)
-            voted_for = json_obj.get('voted_for', None)
-            logs = []
-            for l in json_obj.get('logs', []):
-                entry = Entry.from_bytes(bytes(l, encoding='utf-8'))
-                logs.append(entry)
-            return NodePersistentState(fpath, current_term, voted_for, logs)
-
-    def __init__(self, fpath: str, current_term: int, voted_for: int, logs: List['Entry']):
+        :param fpath: path of state.
+        :param max_batch_size: maximum number of log entries written with a single fsync
+        :param max_delay_ms: how long to hold back a log write for more entries to arrive
+        :param cache_bytes: memory budget for log entries read from disk
+        :param fsync: whether writes are fsynced; only turn this off for benchmarks and tests
+        The term and vote are kept in a HardStateFile, the latest snapshot in a SnapshotFile and the log entries in a
+        SegmentedLog next to fpath. A JSON state file at fpath (the format used before) is imported into them once.
+        """
+        hard_state = HardStateFile(hardstate_fpath(fpath), fsync)
+        snapshot = SnapshotFile(snapshot_fpath(fpath), fsync)
+        log = GroupCommitLog(SegmentedLog(log_dirpath(fpath), fsync=fsync), max_batch_size, max_delay_ms)
+        state = NodePersistentState(fpath, hard_state, snapshot, log, LRUCache(cache_bytes))
+        if not hard_state.exists() and os.path.exists(fpath):
+            with open(fpath, 'r') as f:
+                json_obj = json.loads(f.read() or '{}')
+            LOG.info("NodePersistentState importing %s", fpath)
+            # the hard state is written last, as it marks the import done: a log left by an import cut short is
+            # completed by the next one, which only writes the entries missing from it
+            state.set_logs([Entry.from_bytes(bytes(l, encoding='utf-8')) for l in json_obj.get('logs', [])])
+            state.set_term(json_obj.get('current_term', 0), json_obj.get('voted_for', None))
+        return state
+
+    def __init__(self, fpath: str, hard_state: HardStateFile, snapshot: SnapshotFile, log: GroupCommitLog,
+                 cache: LRUCache):
         self._fpath: str = fpath
-        self._current_term: int = current_term
-        self._voted_for: int = voted_for
-        self._logs: List['Entry'] = logs
+        self._hard_state: HardStateFile = hard_state
+        self._current_term, self._voted_for, self._commit_hint = hard_state.read()
+        self._snapshot: SnapshotFile = snapshot
+        self._snapshot_idx, self._snapshot_term = snapshot.read_header()
+        # serializes writes of the snapshot file, which may run ahead of _snapshot_idx: see write_snapshot
+        self._snapshot_lock: threading.Lock = threading.Lock()
+        self._snapshot_written_idx: int = self._snapshot_idx
+        self._log: GroupCommitLog = log
+        if log.last_idx() < self._snapshot_idx or log.first_idx() > self._snapshot_idx + 1:
+            # the log does not continue from the snapshot, e.g. we crashed while installing one
+            log.reset(self._snapshot_idx)
+        self._cache: LRUCache = cache
 
     def __str__(self) -> str:
         obj = {
             'current_term': self._current_term,
             'voted_for': self._voted_for,
-            'logs': [str(l) for l in self._logs],
+            'logs': [str(l) for l in self.get_logs()],
         }
         return json.dumps(obj)
 
     def get_term(self) -> int:
         return self._current_term
 
-    def set_term(self, new_term):
+    def set_term(self, new_term: int, voted_for: Optional[int] = None):
+        """
+        set_term moves to new_term and records voted_for as the vote cast in it (None if no vote was cast yet),
+        in a single write.
+        """
         self._current_term = new_term
+        self._voted_for = voted_for
         self._save()
 
-    def increment_term(self) -> int:
-        self._current_term += 1
-        self._save()
+    def increment_term(self, voted_for: Optional[int] = None) -> int:
+        """
+        increment_term starts a new term, voting for voted_for in it, in a single write.
+        """
+        self.set_term(self._current_term + 1, voted_for)
         return self._current_term
 
     def get_voted_for(self) -> Optional[int]:
@@ -122,29 +196,270 @@ class NodePersistentState(object):
         self._voted_for = voted_for
         self._save()
 
-    def get_logs(self) -> List['Entry']:
-        return self._logs
+    def get_commit_hint(self) -> int:
+        return self._commit_hint
 
-    def append_log(self, log) -> int:
-        curr_log_idx = len(self._logs)
-        self._logs.append(log)
-        self._save()
-        return curr_log_idx + 1
+    def set_commit_hint(self, commit_idx: int):
+        """
+        set_commit_hint remembers the latest known commit index. It is not written by itself, but rides along with
+        the next term or vote change.
+        """
+        self._commit_hint = commit_idx
+
+    def get_logs(self) -> 'LogView':
+        """
+        get_logs returns a list-like view of the entries held, i.e. those from get_first_log_idx() onwards.
+        """
+        return LogView(self)
+
+    def get_first_log_idx(self) -> int:
+        return self._snapshot_idx + 1
+
+    def get_log(self, idx: int) -> 'Entry':
+        """
+        get_log returns the entry at idx.
+        :raises IndexError: if idx is covered by the snapshot or beyond the end of the log.
+        """
+        if idx <= self._snapshot_idx:
+            raise IndexError('log index %d is covered by the snapshot at %d' % (idx, self._snapshot_idx))
+        entry = self._cache.get(idx)
+        if entry is None:
+            term, data = self._log.read(idx)
+            entry = Entry(term, data)
+            self._cache.put(idx, entry, len(data) + NodePersistentState.ENTRY_OVERHEAD_BYTES)
+        return entry
+
+    def get_log_slice(self, lo: int, hi: int) -> LogSlice:
+        """
+        get_log_slice returns the entries lo..hi-1 (or as many of them as the log holds) as a LogSlice, read in bulk
+        and without creating an Entry for each of them.
+        :raises IndexError: if lo is covered by the snapshot.
+        """
+        if lo <= self._snapshot_idx:
+            raise IndexError('log index %d is covered by the snapshot at %d' % (lo, self._snapshot_idx))
+        return self._log.slice(lo, hi)
+
+    def get_log_term(self, idx: int) -> int:
+        """
+        get_log_term returns the term of the entry at idx. This also works for the last index covered by the
+        snapshot, and index 0, whose term is 0.
+        :raises IndexError: if idx is otherwise covered by the snapshot or beyond the end of the log.
+        """
+        if idx == self._snapshot_idx:
+            return self._snapshot_term
+        if idx < self._snapshot_idx:
+            raise IndexError('log index %d is covered by the snapshot at %d' % (idx, self._snapshot_idx))
+        return self._log.term(idx)
+
+    def get_last_idx_up_to_term(self, term: int) -> int:
+        """
+        get_last_idx_up_to_term returns the index of the last entry whose term is at most term, found by bisection
+        as terms never decrease along the log. Entries covered by the snapshot are not considered: if the snapshot's
+        term is already greater than term, the result is snapshot_idx - 1.
+        """
+        lo, hi = self._snapshot_idx, max(self._snapshot_idx, self._log.last_idx())
+        if self.get_log_term(lo) > term:
+            return lo - 1
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if self.get_log_term(mid) <= term:
+                lo = mid
+            else:
+                hi = mid - 1
+        return lo
+
+    def append_log(self, log, sync: bool = True) -> int:
+        """
+        append_log appends log to the log.
+        :param sync: wait until it is on disk. Otherwise it is written together with any other entries appended
+                     around the same time, and the caller must use wait_durable before relying on it.
+        :return: the index of the appended entry
+        """
+        return self.append_logs([log], sync)
+
+    def append_logs(self, logs: List['Entry'], sync: bool = True) -> int:
+        """
+        append_logs appends logs to the log as a single write.
+        :param sync: as for append_log
+        :return: the index of the last appended entry
+        """
+        last_idx = self._log.append_async([(l._term, l._data) for l in logs])
+        # entries just appended are likely to be read again soon, to replicate and apply them
+        for idx, log in enumerate(logs, last_idx - len(logs) + 1):
+            self._cache.put(idx, log, len(log._data) + NodePersistentState.ENTRY_OVERHEAD_BYTES)
+        if sync:
+            self._log.wait_durable(last_idx)
+        return last_idx
+
+    def wait_durable(self, idx: int):
+        """
+        wait_durable blocks until every entry up to idx is on disk.
+        """
+        self._log.wait_durable(idx)
+
+    def get_durable_idx(self) -> int:
+        """
+        get_durable_idx returns the index of the last entry on disk.
+        """
+        return max(self._snapshot_idx, self._log.durable_idx())
+
+    def get_log_stats(self) -> Dict[str, object]:
+        stats = self._log.get_stats()
+        stats.update(self._cache.get_stats())
+        return stats
 
     def set_logs(self, logs):
-        self._logs = [l for l in logs]
-        self._save()
+        """
+        set_logs replaces the log with logs. Only the part of logs that differs from the current log is written:
+        passing a prefix of the current log, e.g. get_logs()[:n], is a tail truncate.
+        """
+        first_idx = self.get_first_log_idx()
+        if isinstance(logs, LogView) and logs.is_prefix_of(self):
+            self.delete_logs_from(logs.stop_idx())
+            return
+        logs = [l for l in logs]
+        last_idx, _ = self.get_last_log()
+        common = 0
+        while common < len(logs) and first_idx + common <= last_idx and \
+                self.get_log(first_idx + common) == logs[common]:
+            common += 1
+        self.delete_logs_from(first_idx + common)
+        self._log.append([(l._term, l._data) for l in logs[common:]])
+
+    def delete_logs_from(self, idx: int):
+        """
+        delete_logs_from deletes the entry at idx and all that follow it.
+        """
+        idx = max(idx, self._snapshot_idx + 1)
+        self._log.truncate(idx)
+        self._cache.discard(lambda k: k < idx)
 
     def get_last_log(self) -> (int, 'Entry'):
-        try:
-            idx = len(self._logs)
-            return idx, self._logs[idx-1]
-        except IndexError:
-            return 0, None
+        """
+        get_last_log returns the index of the last entry and the entry itself.
+        The entry is None if the log is empty, or every entry is covered by the snapshot.
+        """
+        idx = self._log.last_idx()
+        if idx <= self._snapshot_idx:
+            return self._snapshot_idx, None
+        return idx, self.get_log(idx)
+
+    def get_snapshot(self) -> Tuple[int, int]:
+        """
+        get_snapshot returns the (last_included_idx, last_included_term) of the latest snapshot, or (0, 0).
+        """
+        return self._snapshot_idx, self._snapshot_term
+
+    def read_snapshot(self) -> Tuple[int, int, bytes]:
+        """
+        read_snapshot returns the (last_included_idx, last_included_term, data) of the snapshot file. It may be newer
+        than get_snapshot() while the entries it covers are yet to be discarded, see write_snapshot.
+        """
+        return self._snapshot.read()
+
+    def save_snapshot(self, idx: int, term: int, data: bytes):
+        """
+        save_snapshot stores a snapshot of the state machine with all entries up to and including idx applied,
+        and discards those entries from the log.
+        If the log holds an entry at idx with the given term, the entries following it are kept, otherwise the whole
+        log is discarded (§7).
+        """
+        if self.write_snapshot(idx, term, data):
+            self.compact_snapshot(idx, term)
+
+    def write_snapshot(self, idx: int, term: int, data: bytes) -> bool:
+        """
+        write_snapshot stores a snapshot of the state machine with all entries up to and including idx applied,
+        unless a snapshot at least as new is stored already, but keeps the entries it covers until
+        compact_snapshot(idx, term) is called. Meanwhile, the log still continues from get_snapshot(), so this may be
+        called without holding whatever serializes the other calls, for the write to leave them be.
+        :return: whether the snapshot was written
+        """
+        with self._snapshot_lock:
+            if idx <= max(self._snapshot_idx, self._snapshot_written_idx):
+                return False
+            self._snapshot.write(idx, term, data)
+            self._snapshot_written_idx = idx
+            return True
+
+    def compact_snapshot(self, idx: int, term: int):
+        """
+        compact_snapshot discards the log entries covered by the snapshot written by write_snapshot(idx, term, ...),
+        unless a newer snapshot was saved since.
+        """
+        if idx <= self._snapshot_idx:
+            return
+        last_idx, _ = self.get_last_log()
+        if idx <= last_idx and self.get_log_term(idx) == term:
+            self._log.compact(idx)
+            self._cache.discard(lambda k: k > idx)
+        else:
+            self._log.reset(idx)
+            self._cache.discard(lambda k: False)
+        self._snapshot_idx, self._snapshot_term = idx, term
+        LOG.info("NodePersistentState snapshot last_included_idx:%d last_included_term:%d", idx, term)
+
+    def close(self):
+        """
+        close waits for pending log writes and releases the log files.
+        """
+        self._log.close()
 
     def _save(self):
-        with open(self._fpath, 'w') as f:
-            f.write(str(self))
+        self._hard_state.write(self._current_term, self._voted_for, self._commit_hint)
+
+
+class LogView(object):
+    """
+    LogView is a read-only, list-like view of the log entries held by a NodePersistentState: view[0] is the entry at
+    get_first_log_idx(). Entries are only loaded when accessed, so taking a view or a slice of one is cheap.
+    A view without an explicit end follows the end of the log as it grows and shrinks.
+    """
+
+    def __init__(self, state: 'NodePersistentState', start_idx: Optional[int] = None, stop_idx: Optional[int] = None):
+        self._state: NodePersistentState = state
+        self._start_idx: Optional[int] = start_idx  # log index of view[0], or None for the first index held
+        self._stop_idx: Optional[int] = stop_idx  # log index just past the end of the view, or None
+
+    def start_idx(self) -> int:
+        if self._start_idx is None:
+            return self._state.get_first_log_idx()
+        return self._start_idx
+
+    def stop_idx(self) -> int:
+        last_idx, _ = self._state.get_last_log()
+        if self._stop_idx is None:
+            return last_idx + 1
+        return min(self._stop_idx, last_idx + 1)
+
+    def is_prefix_of(self, state: 'NodePersistentState') -> bool:
+        return self._state is state and self.start_idx() == state.get_first_log_idx()
+
+    def __len__(self) -> int:
+        return max(0, self.stop_idx() - self.start_idx())
+
+    def __bool__(self) -> bool:
+        return len(self) > 0
+
+    def __getitem__(self, i):
+        n = len(self)
+        if isinstance(i, slice):
+            start, stop, step = i.indices(n)
+            if step != 1:
+                return [self[j] for j in range(start, stop, step)]
+            return LogView(self._state, self.start_idx() + start, self.start_idx() + max(start, stop))
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError('LogView index out of range')
+        return self._state.get_log(self.start_idx() + i)
+
+    def __iter__(self) -> Iterator['Entry']:
+        for idx in range(self.start_idx(), self.stop_idx()):
+            yield self._state.get_log(idx)
+
+    def __repr__(self):
+        return 'LogView(%d..%d)' % (self.start_idx(), self.stop_idx() - 1)
 
 
 class BookingData(object):
@@ -178,6 +493,8 @@ class Entry(object):
     Entry represents a single log entry.
     """
 
+    __slots__ = ('_term', '_data')
+
     def __init__(self, term: int, data: bytes):
         self._term: int = term
         self._data: bytes = data
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Stress test for a Raft cluster with a stalled peer: starts a cluster of real nodes in this process, plus one peer that
+accepts connections but never answers, then issues bookings, vote requests and state queries concurrently, and prints
+their latencies as JSON.
+
+A node must keep serving RPCs while one of its peers is stalled, so every request should complete well within the
+client timeout; "stalled_connections" shows how many requests the stalled peer swallowed in the meantime.
+
+Example:
+    $ python3 booking/raft_stress.py --nodes 3 --clients 8 --requests 50
+"""
+import argparse
+import concurrent.futures
+import json
+import logging
+import socket
+import sys
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, List
+
+from raft_cluster import percentile, start_cluster, wait_for_leader
+from raft_messages import DbEntriesMessage, StateMessage, VoteMessage
+from raft_peer import Peer
+from raft_rpc_client import RpcClient
+
+
+class StalledPeer(object):
+    """
+    StalledPeer accepts connections and reads requests, but never replies, like a peer that has hung.
+    """
+
+    def __init__(self, host: str, port: int):
+        self.connections: int = 0
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((host, port))
+        self._sock.listen(64)
+        self._held: List[socket.socket] = []
+
+    def start(self):
+        thread = threading.Thread(target=self._accept_forever)
+        thread.daemon = True
+        thread.start()
+
+    def _accept_forever(self):
+        while True:
+            conn, _ = self._sock.accept()
+            self.connections += 1
+            # keep the connection open so that the sender waits for a reply that never comes
+            self._held.append(conn)
+
+
+def send_state(peer: Peer, timeout: float) -> bytes:
+    """
+    Queries the state of peer: unlike the other verbs, its reply is free text.
+    """
+    with socket.create_connection(peer.hostport(), timeout=timeout) as sock:
+        sock.sendall(bytes(StateMessage()) + b'\n')
+        return b''.join(iter(lambda: sock.recv(1024), b''))
+
+
+def timed(fn: Callable, latencies: Dict[str, List[float]], errors: Dict[str, int], verb: str, lock: threading.Lock):
+    t = time.perf_counter()
+    try:
+        ok = fn()
+    except Exception:
+        ok = False
+    elapsed = time.perf_counter() - t
+    with lock:
+        latencies[verb].append(elapsed)
+        if not ok:
+            errors[verb] += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stress a Raft cluster while one of its peers is stalled")
+    parser.add_argument("--nodes", type=int, default=3, help="real nodes in the cluster, besides the stalled peer")
+    parser.add_argument("--port", type=int, default=9300, help="first port; the stalled peer uses the last one")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent clients")
+    parser.add_argument("--requests", type=int, default=50, help="requests of each verb")
+    parser.add_argument("--timeout", type=float, default=5.0, help="client timeout, in seconds")
+    parser.add_argument("--dir", type=str, default=None, help="where to keep the nodes' data (default: a temporary "
+                                                              "directory, which is not removed)")
+    parser.add_argument("--verbose", action="store_true", help="log what the nodes are doing")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.disable(logging.CRITICAL)
+
+    host = '127.0.0.1'
+    ids = list(range(args.nodes + 1))
+    stalled_id = ids[-1]
+    stalled = StalledPeer(host, args.port + stalled_id)
+    stalled.start()
+
+    # the nodes keep running until we exit, so their data is left in place, for inspection
+    dirpath = tempfile.mkdtemp(prefix='raft_stress.', dir=args.dir)
+    nodes = start_cluster(dirpath, host, args.port, ids[:-1], ids, election_timeout_ms_min=300,
+                          election_timeout_ms_max=600, loop_interval_ms=100, snapshot_threshold=0)
+
+    leader = wait_for_leader(nodes, 30)
+    leader_peer = Peer(leader._node_id, host, args.port + leader._node_id)
+    all_peers = [leader_peer] + [Peer(n._node_id, host, args.port + n._node_id) for n in nodes if n is not leader]
+    client = RpcClient(timeout=args.timeout)
+
+    def book(i: int) -> bool:
+        _, ok = client.send(leader_peer, DbEntriesMessage(100 + i % 900))
+        return ok
+
+    def vote(i: int) -> bool:
+        # a vote from a stale term: answered straight away, but through the same lock as everything else
+        term, _ = client.send(all_peers[i % len(all_peers)], VoteMessage(0, stalled_id, 0, 0))
+        return term is not None
+
+    def state(i: int) -> bool:
+        return bool(send_state(all_peers[i % len(all_peers)], args.timeout))
+
+    verbs: Dict[str, Callable[[int], bool]] = {'db': book, 'vote': vote, 'state': state}
+    latencies: Dict[str, List[float]] = {verb: [] for verb in verbs}
+    errors: Dict[str, int] = {verb: 0 for verb in verbs}
+    lock = threading.Lock()
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.clients) as pool:
+        for i in range(args.requests):
+            for verb, fn in verbs.items():
+                pool.submit(timed, lambda fn=fn, i=i: fn(i), latencies, errors, verb, lock)
+    elapsed = time.perf_counter() - start
+
+    results = []
+    for verb in verbs:
+        results.append({
+            'verb': verb,
+            'requests': len(latencies[verb]),
+            'errors': errors[verb],
+            'p50_ms': round(percentile(latencies[verb], 50) * 1000, 3),
+            'p99_ms': round(percentile(latencies[verb], 99) * 1000, 3),
+            'max_ms': round(max(latencies[verb], default=0) * 1000, 3),
+        })
+    report = {
+        'nodes': args.nodes,
+        'leader': leader._node_id,
+        'seconds': round(elapsed, 3),
+        'dir': dirpath,
+        'stalled_connections': stalled.connections,
+        'results': results,
+    }
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    slow = [r['verb'] for r in results if r['max_ms'] >= args.timeout * 1000]
+    if slow:
+        sys.exit('requests timed out while a peer was stalled: %s' % ', '.join(slow))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,7 @@ from forms.login import LoginForm
 import operation
 import os
 from raft_example import *
-from raft_messages import DbEntriesMessage
+from raft_messages import DbEntriesMessage, ReadIndexMessage
 from raft_peer import Peer
 from raft_rpc_client import RpcClient
 import random
@@ -16,6 +16,10 @@ DBPATH = os.environ['DB_PATH']
 DBTABLE = 'room'
 DBCONN = operation.connect(DBPATH)
 operation.create_table(DBCONN, DBTABLE)
+# DBCONN belongs to the Raft node, which applies bookings through it under a lock of its own. The views read through
+# a connection of their own, taking turns on it between Flask's threads, so they only ever see committed bookings
+VIEW_DBCONN = operation.connect(DBPATH)
+VIEW_DBLOCK = threading.Lock()
 
 def raft_init():
     peer_value = os.environ['PEERS'].split(' ')
@@ -31,7 +35,18 @@ def raft_init():
         peers.append(p)
 
     prev_state = NodePersistentState.load(state_path)
-    node = Node(node_id, prev_state, peers, DBCONN)
+    timeouts = {}
+    if 'RAFT_ELECTION_TIMEOUT_MS' in os.environ:
+        # e.g. 150-300: the range election timeouts are picked from
+        timeout_min, timeout_max = os.environ['RAFT_ELECTION_TIMEOUT_MS'].split('-')
+        timeouts['election_timeout_ms_min'] = int(timeout_min)
+        timeouts['election_timeout_ms_max'] = int(timeout_max)
+    if 'RAFT_HEARTBEAT_MS' in os.environ:
+        timeouts['loop_interval_ms'] = int(os.environ['RAFT_HEARTBEAT_MS'])
+    # RAFT_LEASE_READS=1 lets the leader serve reads under its lease, without a round of heartbeats for each.
+    # RAFT_PRE_VOTE=0 starts elections without asking the peers first, as nodes that do not know the prevote verb do
+    node = Node(node_id, prev_state, peers, DBCONN, lease_reads=os.environ.get('RAFT_LEASE_READS') == '1',
+                pre_vote=os.environ.get('RAFT_PRE_VOTE') != '0', **timeouts)
     node_thread = threading.Thread(target=node.start, args=[self_host, self_port])
     node_thread.daemon = True
     node_thread.start()
@@ -40,6 +55,14 @@ def raft_init():
 raft_init()
 
 
+def select_rooms():
+    """
+    :return: the unoccupied and the occupied rows of the room table
+    """
+    with VIEW_DBLOCK:
+        return operation.select(VIEW_DBCONN, DBTABLE), operation.select(VIEW_DBCONN, DBTABLE, 'occupied')
+
+
 @sv.route('/user/<name>')
 def user(name):
     return render_template('user.html', name=name)
@@ -60,8 +83,10 @@ def login():
 @sv.route('/api/bookings', methods=['GET', 'POST'])
 def api_bookings():
     rpc_client, peer = rpc_set_up()
-    unoccupied = [t[1] for t in operation.select(DBCONN, DBTABLE)]
-    occupied = [t[1] for t in operation.select(DBCONN, DBTABLE, 'occupied')]
+    wait_for_reads(rpc_client, peer)
+    unoccupied, occupied = select_rooms()
+    unoccupied = [t[1] for t in unoccupied]
+    occupied = [t[1] for t in occupied]
     if request.method == 'GET':
         return jsonify({
             'occupied': occupied,
@@ -79,12 +104,16 @@ def api_bookings():
             abort(make_response(jsonify(message="roomid:%d already occupied" % (requested_room_id)), 400))
 
         booking_request_msg = DbEntriesMessage(requested_room_id)
-        _, ok = rpc_client.send(peer, booking_request_msg)
+        _, ok, booked = rpc_client.send_booking(peer, booking_request_msg)
         if not ok:
             abort(make_response(jsonify(message="unable to send booking request to raft"), 500))
             return
+        if booked == 0:
+            abort(make_response(jsonify(message="roomid:%d already occupied" % (requested_room_id)), 400))
+        if booked < 0:
+            abort(make_response(jsonify(message="roomid:%d could not be booked" % (requested_room_id)), 400))
 
-        return jsonify(message="booking request sent")
+        return jsonify(message="roomid:%d booked" % (requested_room_id))
 
     abort(make_response(jsonify(message="only GET and POST methods supported"), 405))
 
@@ -92,8 +121,8 @@ def api_bookings():
 @sv.route('/search', methods=['GET', 'POST'])
 def search():
     rpc_client, peer = rpc_set_up()
-    unoccupied = operation.select(DBCONN, DBTABLE)
-    occupied = operation.select(DBCONN, DBTABLE, 'occupied')
+    wait_for_reads(rpc_client, peer)
+    unoccupied, occupied = select_rooms()
     labels = ['RoomID']
     occupied_room_id = [i[1] for i in occupied]
     unoccupied_room_id = [i[1] for i in unoccupied]
@@ -102,15 +131,11 @@ def search():
         for idx in unoccupied_room_id:
             if request.values.get(str(idx)) == 'Y':
                 # result[idx] = operation.update(DBCONN, table_name, idx)
-                message_sent, success = rpc_client.send(peer, b"db %d" % int(idx))
-                if success == 'False':
-                    if message_sent == -2:
-                        return redirect(url_for('.success_book', message=message_sent, s=success))
-                    else:
-                        # By pass conditional for now until can receive leader id.
-                        return redirect(url_for('.success_book', message="redirection to leader", s=False))
-                else:
-                    return redirect(url_for('.success_book', message=message_sent, s=success))
+                log_idx, ok, booked = rpc_client.send_booking(peer, DbEntriesMessage(int(idx)))
+                if log_idx == -2:
+                    # the booking was forwarded to the leader, which does not tell us how it went
+                    return redirect(url_for('.success_book', message=log_idx, s=False))
+                return redirect(url_for('.success_book', message=idx, s=ok and booked == 1))
 
         if len(result):
             for idx, flag in result.items():
@@ -143,6 +168,22 @@ def success_book():
             return "Unsuccessfully booking"
 
 
+def wait_for_reads(rpc_client, peer):
+    """
+    Waits until our database reflects every booking committed before now, so that reads from it are up to date.
+    A request may allow a stale read with the max_lag (committed bookings not yet applied) and max_staleness_ms
+    (since our node last heard from the leader) parameters, which a node within both serves without the leader.
+    """
+    msg = ReadIndexMessage(max_lag_entries=request.args.get('max_lag', type=int),
+                           max_staleness_ms=request.args.get('max_staleness_ms', type=int))
+    try:
+        _, ok, _ = rpc_client.send_read_index(peer, msg)
+    except Exception:
+        ok = False
+    if not ok:
+        abort(make_response(jsonify(message="unable to reach the raft leader to read the latest bookings"), 503))
+
+
 def rpc_set_up():
     peer_value = os.environ['SELF']
     peer_id, host, port = parse_peer(peer_value)
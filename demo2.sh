@@ -31,7 +31,7 @@ function dump_raft_disk_state {
   echo "--- raft persistent state ---"
   for n in $(seq 0 2); do
     echo "data/state_$n.json"
-    jq < "data/state_$n.json"
+    python3 booking/raft_log.py "data/state_$n.json"
   done
 }
 